@@ -1,130 +1,374 @@
-from models.blocks import *
-from models.net.resnet import Bottleneck
+import functools
+
+import torch.fx as fx
 import torch.nn.functional as F
+from torch.fx.passes.split_module import split_module
+from torch.utils.checkpoint import checkpoint
+
+from models.base_model import NormalizeLayer
+from models.blocks import *
+
+# functional activations that are rewritten as well as the activation modules (see check_activation)
+ACT_FUNCTIONS = [F.relu, torch.relu, F.leaky_relu, F.gelu, torch.sigmoid, F.sigmoid, torch.tanh]
+
+
+class DualTracer(fx.Tracer):
+    """
+    Tracer that keeps activations and input normalization layers as leaves
+    """
+
+    def is_leaf_module(self, m, module_qualified_name):
+        if check_activation(m) or type(m) in [NormalizeLayer, InputCenterLayer]:
+            return True
+        return super().is_leaf_module(m, module_qualified_name)
+
+
+class MaskedAct(nn.Module):
+    """
+    Replaces the activation nodes of a traced network: masks the pre-activation through DualNet, then activates
+    """
+
+    def __init__(self, layer, act, mask_act):
+        super().__init__()
+        self.layer = layer
+        self.act = act
+        self.mask_act = mask_act
+
+    def forward(self, x):
+        return self.mask_act(self.layer, self.act, x)
+
+
+class MaskScale(torch.autograd.Function):
+    """
+    Fused x_mask(x, eta_fixed, fixed) + x_mask(x, eta_float, ~fixed).
+    The gradient of fixed / float neurons is scaled by 1 + eta_fixed / 1 + eta_float, the forward value is kept
+    (balance) or scaled by the same factors. Only the mask is saved for backward.
+    """
+
+    @staticmethod
+    def forward(ctx, x, fixed, eta_fixed, eta_float, balance=True):
+        ctx.save_for_backward(fixed)
+        ctx.eta = (eta_fixed, eta_float)
+        if balance:
+            return x * 1
+        return MaskScale.scale(x, fixed, 1 + eta_fixed, 1 + eta_float)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        fixed, = ctx.saved_tensors
+        eta_fixed, eta_float = ctx.eta
+        return MaskScale.scale(grad_output, fixed, 1 + eta_fixed, 1 + eta_float), None, None, None, None
+
+    @staticmethod
+    def scale(x, fixed, scale_fixed, scale_float):
+        # scale_fixed and scale_float are numbers, or tensors broadcastable against x (one value per setting)
+        if not torch.is_tensor(scale_fixed) and not torch.is_tensor(scale_float) and scale_fixed == scale_float:
+            return x * scale_fixed
+        scale_fixed = torch.as_tensor(scale_fixed, dtype=x.dtype, device=x.device)
+        scale_float = torch.as_tensor(scale_float, dtype=x.dtype, device=x.device)
+        return x * torch.where(fixed, scale_fixed, scale_float)
+
+
+class CheckpointSegment(nn.Module):
+    """
+    Segment of a split DualNet graph, its activations are recomputed in backward instead of being stored
+    """
+
+    def __init__(self, module, run_segment):
+        super().__init__()
+        self.module = module
+        self.run_segment = run_segment
+
+    def forward(self, *args):
+        return self.run_segment(self.module, *args)
+
 
 class DualNet(nn.Module):
     def __init__(self, net, args):
         super().__init__()
         self.net = net
         self.gamma = set_gamma(args.activation)
+        self.eta_dn = getattr(args, 'eta_dn', 0)
+        self.dn_rate = getattr(args, 'dn_rate', 0.9)
+        self.lip = False
+        # number of activations per checkpointed segment in forward, 0 keeps every activation for backward
+        self.ckpt = getattr(args, 'dual_ckpt', 0)
+
+        # traced and rewritten modules, kept out of the registered submodules so that the parameters
+        # of self.net are not listed twice
+        self._traced = {}
 
-        self.counter = -1
+        # state of the current call, read by mask_act at every activation
+        self.mode = None
+        self.eta_fixed, self.eta_float, self.balance = 0, 0, True
+        self.segments, self.segment_ids, self.anchors = None, None, None
+        self.patterns = []
+        self.replay = []
+        self.df = None
+        self.record = True
+
+        # number of (eta_fixed, eta_float) settings evaluated together by predict, and rows per setting
+        self.settings, self.rows = 1, 0
+
+        # fixed-neuron statistics accumulated on the device by predict, see reset_stats
+        self.stat_segments = 0
+        self.fixed_counts, self.neurons, self.stat_samples = [], [], None
 
         self.fixed_neurons = []
-        self.handles = []
+
+    @property
+    def graph_net(self):
+        return self.transform(self.net)
 
     @property
     def count_block_len(self):
-        counter = 0
-        for module in self.net.layers.children():
-            if type(module) in [ConvBlock, LinearBlock, Bottleneck]:
-                counter += 1
-        return counter - 1
-
-    def predict(self, x, eta_fixed, eta_float):
-        """
-        for a batch of data, the first one should be raw data without perturbation
-        """
-        self.counter = -1
-        fixed_neurons = []
-        batch_x = self.net.norm_layer(x)
-        for i, module in enumerate(list(self.net.layers)):
-            batch_x = self.compute_pre_act(module, batch_x)
-            if self.check_block(module) and i != len(list(self.net.layers)):
-                fixed = self.compute_fix_single_batch(batch_x)
-                fixed_neurons += [fixed]
-
-                h = self.set_hook(fixed, eta_fixed, eta_float, False)
-                self.handles += [module.Act.register_forward_pre_hook(h)]
-                batch_x = module.Act(batch_x)
-            else:
-                fixed_neurons += [None]
+        return len([m for m in self.graph_net.modules() if type(m) == MaskedAct])
 
-        self.fixed_neurons = fixed_neurons
-        self.remove_handles()
-        return batch_x
+    def transform(self, module):
+        """
+        Trace the module with torch.fx and rewrite every activation node into a MaskedAct, the result is cached
+        """
+        key = id(module)
+        if key not in self._traced:
+            graph_module = fx.GraphModule(module, DualTracer().trace(module))
+            layer = 0
+            for node in list(graph_module.graph.nodes):
+                act = self._node_activation(graph_module, node)
+                if act is None:
+                    continue
+                name = 'dual_act_{}'.format(layer)
+                graph_module.add_submodule(name, MaskedAct(layer, act, self.mask_act))
+                with graph_module.graph.inserting_after(node):
+                    masked = graph_module.graph.call_module(name, (node.args[0],))
+                node.replace_all_uses_with(masked)
+                graph_module.graph.erase_node(node)
+                layer += 1
+            graph_module.recompile()
+            self._traced[key] = graph_module
+        return self._traced[key]
 
-    def forward(self, x_1, x_2, eta_fixed, eta_float, balance=True):
-        self.counter = -1
-        fixed_neurons = []
-        df = torch.tensor(1, dtype=torch.float).cuda()
-        for i, module in enumerate(self.net.layers.children()):
-            x_1 = self.compute_pre_act(module, x_1)
-            x_2 = self.compute_pre_act(module, x_2)
-            if self.check_block(module) and i != len(self.net.layers) - 1:
-                fixed = self.compute_fix(x_1, x_2)
-                fixed_neurons += [fixed]
-                if self.check_lip():
-                    df += (x_1 * fixed).abs().mean()
-
-                h = self.set_hook(fixed, eta_fixed, eta_float, balance)
-                self.handles += [module.Act.register_forward_pre_hook(h)]
-                x_1 = module.Act(x_1)
-                x_2 = module.Act(x_2)
+    def checkpointed(self, segment_size):
+        """
+        Split the rewritten network into segments of segment_size activations, the activations inside a segment
+        are not stored but recomputed in backward. Larger segments store less and recompute more.
+        """
+        key = ('checkpoint', segment_size)
+        if key not in self._traced:
+            graph_module = self.graph_net
+            partitions, num_act = {}, 0
+            for node in graph_module.graph.nodes:
+                partitions[node] = num_act // segment_size
+                if node.op == 'call_module' and type(graph_module.get_submodule(node.target)) == MaskedAct:
+                    num_act += 1
+            split = split_module(graph_module, graph_module, lambda node: partitions[node])
+            for name, module in list(split.named_children()):
+                setattr(split, name, CheckpointSegment(module, self.run_segment))
+            self._traced[key] = split
+        return self._traced[key]
+
+    def run_segment(self, module, *args):
+        if not torch.is_grad_enabled():
+            return module(*args)
+        state = {'mode': self.mode, 'eta_fixed': self.eta_fixed, 'eta_float': self.eta_float, 'balance': self.balance}
+        return checkpoint(self._recompute, module, state, *args, use_reentrant=False)
+
+    def _recompute(self, module, state, *args):
+        if self.mode is not None:
+            return module(*args)
+        # recomputation in backward, run has already returned and cleared the state of the call
+        for k, v in state.items():
+            setattr(self, k, v)
+        self.record = False
+        try:
+            return module(*args)
+        finally:
+            self.mode = None
+            self.record = True
+
+    @staticmethod
+    def _node_activation(graph_module, node):
+        if node.op == 'call_module' and check_activation(graph_module.get_submodule(node.target)):
+            return graph_module.get_submodule(node.target)
+        elif node.op == 'call_function' and node.target in ACT_FUNCTIONS:
+            extra = list(node.args[1:]) + list(node.kwargs.values())
+            if any(isinstance(arg, fx.Node) for arg in extra):
+                return None
+            return functools.partial(node.target, *node.args[1:], **node.kwargs)
+        else:
+            return None
+
+    def run(self, mode, x, net=None, **state):
+        """
+        Run the rewritten network in the given mode, the state is visible to mask_act during this call only.
+        net may be a part of the rewritten network (e.g. the trunk of AffineShortcut), it runs the whole net if None.
+        """
+        self.mode = mode
+        self.fixed_neurons = []
+        for k, v in state.items():
+            setattr(self, k, v)
+        if net is None and mode == 'pair' and self.ckpt > 0 and torch.is_grad_enabled():
+            net = self.checkpointed(self.ckpt)
+        elif net is None:
+            net = self.graph_net
+        try:
+            return net(x)
+        finally:
+            self.mode = None
+            self.segments, self.segment_ids, self.anchors = None, None, None
+
+    def mask_act(self, layer, act, x):
+        if self.mode is None:
+            return act(x)
+        elif self.mode == 'anchor':
+            self.patterns += [torch.stack([x > g for g in self.gamma])]
+            return act(x * (1 + self.eta_fixed))
+        elif self.mode == 'pair':
+            # clean and noisy branches are stacked along the batch dimension
+            x_pair = x.view((2, -1) + x.shape[1:])
+            fixed = self.compute_fix(x_pair[0], x_pair[1])
+            if self.record:
+                if self.lip:
+                    self.df = self.df + (x_pair[0] * fixed).abs().mean()
+                self.fixed_neurons += [fixed]
+            x_pair = MaskScale.apply(x_pair, fixed, self.eta_fixed, self.eta_float, self.balance)
+            return act(x_pair.view_as(x))
+        elif self.mode == 'dn':
+            p0 = (x < 0).sum(axis=0) > self.dn_rate * len(x)
+            p1 = (x > 0).sum(axis=0) > self.dn_rate * len(x)
+            p_same = torch.all(torch.stack([p0, p1]), dim=0).unsqueeze(dim=0)
+            return act(MaskScale.apply(x, p_same, self.eta_dn, 0, True))
+
+        if self.mode == 'predict' and self.settings > 1:
+            # rows of all settings are stacked along the first dimension, the first activation still sees one copy
+            x_set = x.view((-1, self.rows) + x.shape[1:])
+            fixed = self.compute_fix_anchor(x_set, self.anchors[layer], self.segment_ids)
+            if self.stat_segments:
+                self.count_fixed(layer, fixed)
+            self.fixed_neurons += [fixed]
+            shape = (-1,) + (1,) * (x_set.dim() - 1)
+            x_set = MaskScale.apply(x_set, fixed, self.eta_fixed.view(shape), self.eta_float.view(shape), False)
+            return act(x_set.reshape((-1,) + x.shape[1:]))
+        elif self.mode == 'predict':
+            if self.anchors is None:
+                fixed = self.compute_fix_single_batch(x, self.segments)
             else:
-                fixed_neurons += [None]
+                fixed = self.compute_fix_anchor(x, self.anchors[layer], self.segment_ids)
+            if self.stat_segments:
+                self.count_fixed(layer, fixed)
+        else:
+            # replay the masks of the previous call
+            fixed = self.replay[layer]
+        self.fixed_neurons += [fixed]
+        return act(MaskScale.apply(x, fixed, self.eta_fixed, self.eta_float, self.balance))
+
+    def predict(self, x, eta_fixed, eta_float, segment_ids=None, anchors=None):
+        """
+        for a batch of data, the first one should be raw data without perturbation.
+        If segment_ids is given, the batch holds several images: rows with the same id belong to the same image,
+        ids must be contiguous and the first row of each segment is the anchor of that image.
+        If anchors (from anchor_pattern) is given, the batch holds noisy samples only, and each row is compared
+        against the cached pattern of anchor segment_ids[row] (of anchor 0 if segment_ids is None).
+        eta_fixed and eta_float may be 1-d tensors of several settings (anchors are then required): the batch is
+        shared up to the first activation, where it is expanded to one copy per setting. The output then holds
+        [num_settings * len(x)] rows, setting-major.
+        """
+        settings = max(self.num_settings(eta_fixed), self.num_settings(eta_float))
+        if settings > 1:
+            if anchors is None:
+                raise ValueError('Several eta settings need cached anchors, see anchor_pattern')
+            eta_fixed = torch.as_tensor(eta_fixed, dtype=torch.float, device=x.device).expand(settings)
+            eta_float = torch.as_tensor(eta_float, dtype=torch.float, device=x.device).expand(settings)
+        segments = self.split_segments(segment_ids) if segment_ids is not None and anchors is None else None
+        if self.stat_segments:
+            if self.stat_samples is None:
+                self.stat_samples = torch.zeros(self.stat_segments, dtype=torch.long, device=x.device)
+            # rows of every segment, the same for every setting
+            if segment_ids is None:
+                self.stat_samples += len(x)
+            else:
+                self.stat_samples += torch.bincount(segment_ids, minlength=self.stat_segments)
+        try:
+            return self.run('predict', x, eta_fixed=eta_fixed, eta_float=eta_float, balance=False,
+                            segments=segments, segment_ids=segment_ids, anchors=anchors,
+                            settings=settings, rows=len(x))
+        finally:
+            self.settings = 1
+
+    @staticmethod
+    def num_settings(eta):
+        return len(eta) if torch.is_tensor(eta) and eta.dim() > 0 or type(eta) in [list, tuple] else 1
+
+    def anchor_pattern(self, x, eta_fixed):
+        """
+        Record on which side of each breakpoint every neuron of the clean inputs lies, so that predict can reuse
+        it for all batches of the same inputs instead of pushing the anchors through the network again.
+        @param x: clean inputs [num_anchors x channel x height x width]
+        @param eta_fixed: the eta_fixed later passed to predict, every neuron of an anchor is fixed w.r.t. itself
+        @return: one bool tensor of shape [len(Gamma) x num_anchors x ...] for each activation
+        """
+        self.patterns = []
+        self.run('anchor', x, eta_fixed=eta_fixed)
+        patterns, self.patterns = self.patterns, []
+        return patterns
 
-        self.fixed_neurons = fixed_neurons
-        self.remove_handles()
-        return x_1, x_2, df
+    def forward(self, x_1, x_2, eta_fixed, eta_float, balance=True):
+        self.df = torch.tensor(1, dtype=torch.float, device=x_1.device)
+        out = self.run('pair', torch.cat([x_1, x_2]), eta_fixed=eta_fixed, eta_float=eta_float, balance=balance)
+        return out[:len(x_1)], out[len(x_1):], self.df
 
     def mask_forward(self, x, eta_fixed, eta_float):
-        self.counter = -1
-        fixed_neurons = []
-        for i, (fixed, module) in enumerate(zip(self.fixed_neurons, self.net.layers.children())):
-            x = self.compute_pre_act(module, x)
-            if self.check_block(module) and i != len(self.net.layers) - 1:
-                fixed_neurons += [fixed]
-
-                h = self.set_hook(fixed, eta_fixed, eta_float)
-                self.handles += [module.Act.register_forward_pre_hook(h)]
-                x = module.Act(x)
-        self.remove_handles()
-        return x
-
-    def remove_handles(self):
-        for h in self.handles:
-            h.remove()
-        self.handles.clear()
-        return
-
-    def set_hook(self, fixed, eta_fixed, eta_float, balance=True):
-        def forward_pre_hook(m, inputs):
-            x = inputs[0]
-            return self.x_mask(x, eta_fixed, fixed, balance) + self.x_mask(x, eta_float, ~fixed, balance)
-
-        return forward_pre_hook
-
-    def check_block(self, module):
-        if type(module) in [ConvBlock, LinearBlock, Bottleneck]:
-            self.counter += 1
-            return 1
-        else:
-            return 0
+        return self.run('replay', x, eta_fixed=eta_fixed, eta_float=eta_float, balance=True,
+                        replay=self.fixed_neurons)
 
     def dn_forward(self, x):
-        for i, module in enumerate(self.net.layers.children()):
-            x = self.compute_pre_act(module, x)
-            if type(module) in [ConvBlock, LinearBlock]:
-                p0 = (x < 0).sum(axis=0) > self.dn_rate * len(x)
-                p1 = (x > 0).sum(axis=0) > self.dn_rate * len(x)
-                p_same = torch.all(torch.stack([p0, p1]), dim=0).unsqueeze(dim=0)
-                x = self.x_mask(x, self.eta_dn, p_same) + x * ~p_same
-                x = module.Act(x)
-        return x
+        return self.run('dn', x)
 
     @property
     def mask_ratio(self):
-        mask_mean = []
+        """
+        Ratio of fixed neurons over all masked activations of the last call
+        """
         if len(self.fixed_neurons) == 0:
             return 0
-        for b_mask in self.fixed_neurons:
-            if b_mask is not None:
-                mask_mean += [to_numpy(b_mask).mean()]
-            return np.array(mask_mean).mean()
+        return torch.stack([b_mask.float().mean() for b_mask in self.fixed_neurons]).mean().item()
+
+    def reset_stats(self, num_segments):
+        """
+        Start accumulating the number of fixed neurons of every row passed to predict, per eta setting, per segment
+        and per activation. The counts stay on the device until fixed_ratio is called, 0 switches the statistics
+        off. Every call to predict until the next reset must evaluate the same number of settings.
+        @param num_segments: number of segments, segment ids passed to predict must lie in [0, num_segments)
+        """
+        self.stat_segments = num_segments
+        self.fixed_counts, self.neurons, self.stat_samples = [], [], None
+
+    def count_fixed(self, layer, fixed):
+        # fixed is [rows x ...], or [settings x rows x ...] (a single copy before the first activation)
+        copies = fixed.shape[0] if self.settings > 1 else 1
+        neurons = fixed.numel() // (copies * self.rows)
+        # [settings x rows], the single copy before the first activation is the same for every setting
+        per_row = fixed.reshape(copies, self.rows, neurons).sum(2).expand(self.settings, -1)
+        if len(self.fixed_counts) == layer:
+            self.fixed_counts += [torch.zeros((self.settings, self.stat_segments), dtype=torch.long,
+                                              device=fixed.device)]
+            self.neurons += [neurons]
+        if self.segment_ids is None:
+            self.fixed_counts[layer] += per_row.sum(1, keepdim=True)
+        else:
+            self.fixed_counts[layer].index_add_(1, self.segment_ids, per_row)
+
+    def fixed_ratio(self):
+        """
+        @return: ndarray [num_settings x num_segments x num_activations], the ratio of fixed neurons since
+                 reset_stats
+        """
+        counts = torch.stack(self.fixed_counts, dim=2).double()
+        neurons = torch.tensor(self.neurons, dtype=torch.double, device=counts.device)
+        return to_numpy(counts / (self.stat_samples.double()[None, :, None] * neurons))
 
     @staticmethod
     def x_mask(x, ratio, mask, balance=True):
+        # reference implementation of one half of MaskScale
         if ratio == 0:
             return x * mask
         else:
@@ -133,32 +377,57 @@ class DualNet(nn.Module):
             else:
                 return x * (1 + ratio) * mask
 
+    def compute_fix(self, x_1, x_2):
+        """
+        A neuron is fixed if x_1 and x_2 fall on the same side of every breakpoint in Gamma.
+        x_1 and x_2 only need to be broadcastable, so a single anchor row can be compared against a whole batch.
+        """
+        fixed = self._same_side(x_1, x_2, self.gamma[0])
+        for g in self.gamma[1:]:
+            fixed &= self._same_side(x_1, x_2, g)
+        return fixed
+
+    def compute_fix_single_batch(self, batch_x, segments=None):
+        """
+        The anchor (row 0) is broadcast against the batch instead of being repeated to the batch size.
+        With segments (see split_segments), every row is compared against the anchor of its own segment.
+        """
+        if segments is None:
+            return self.compute_fix(batch_x[:1], batch_x)
+        anchor_rows, segment_index = segments
+        anchor = batch_x[anchor_rows]
+        fixed = torch.eq((anchor > self.gamma[0])[segment_index], batch_x > self.gamma[0])
+        for g in self.gamma[1:]:
+            fixed &= torch.eq((anchor > g)[segment_index], batch_x > g)
+        return fixed
+
+    def compute_fix_anchor(self, batch_x, anchor, segment_ids=None):
+        """
+        Compare every row against a cached anchor pattern (see anchor_pattern)
+        """
+        if segment_ids is not None:
+            anchor = anchor[:, segment_ids]
+        fixed = torch.eq(anchor[0], batch_x > self.gamma[0])
+        for k, g in enumerate(self.gamma[1:], 1):
+            fixed &= torch.eq(anchor[k], batch_x > g)
+        return fixed
+
     @staticmethod
-    def compute_pre_act(module, x):
-        if type(module) == ConvBlock:
-            return module.BN(module.Conv(x))
-        elif type(module) == LinearBlock:
-            return module.BN(module.FC(x))
-        elif type(module) == Bottleneck:
-            out = module.bottle_net(x)
-            identity = module.downsample(x)
-
-            return out + identity
-        else:
-            return module(x)
+    def split_segments(segment_ids):
+        """
+        @param segment_ids: contiguous segment id of each row
+        @return: row index of each segment's anchor, and the segment index of each row
+        """
+        first = torch.ones_like(segment_ids, dtype=torch.bool)
+        first[1:] = segment_ids[1:] != segment_ids[:-1]
+        anchor_rows = torch.nonzero(first).squeeze(1)
+        segment_index = torch.cumsum(first, dim=0) - 1
+        return anchor_rows, segment_index
 
-    def compute_fix(self, x_1, x_2):
-        if len(self.gamma) == 0:
-            return (x_1 - self.gamma[0]) * (x_2 - self.gamma[0]) > 0
-        else:
-            stacked = torch.stack([(x_1 - g) * (x_2 - g) > 0 for g in self.gamma])
-            return torch.all(stacked, dim=0)
-
-    def compute_fix_single_batch(self, batch_x):
-        dims = len(batch_x.shape)
-        if len(self.gamma) == 1:
-            x_0_pattern = (batch_x - self.gamma[0])[0].repeat((len(batch_x),) + (1,) * (dims - 1))
-            return x_0_pattern * (batch_x - self.gamma[0]) > 0
+    @staticmethod
+    def _same_side(x_1, x_2, g):
+        # boolean comparisons only, no activation-sized float temporaries
+        return torch.eq(x_1 > g, x_2 > g)
 
     @staticmethod
     def _batch_norm(layer, x):
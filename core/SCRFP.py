@@ -15,6 +15,55 @@ class SCRFP(Smooth):
         """
         super().__init__(base_classifier, args)
         self.dual_net = DualNet(base_classifier, args)
+        # activation pattern of the inputs being certified, shared by the selection and estimation batches
+        self.anchors = None
+        # [num_settings x num_inputs x num_activations] ratio of fixed neurons over the samples of the last
+        # certification, for every eta_float setting
+        self.fixed_ratio = None
+        # eta_float settings evaluated together on the same noise, see certify_sweep
+        self.eta_floats = args.eta_sweep if getattr(args, 'eta_sweep', None) else [args.eta_float]
+
+    def certify(self, x: torch.tensor, n0: int, n: int, alpha: float, batch_size: int) -> (int, float):
+        return self.certify_sweep(x.unsqueeze(0), n0, n, alpha, batch_size)[0][0]
+
+    def certify_packed(self, xs: torch.tensor, n0: int, n: int, alpha: float, batch_size: int) -> list:
+        """ Certify several inputs at once, every forward pass carries noisy samples of all of them.
+
+        :param xs: the inputs [num_inputs x channel x height x width]
+        :param n0: the number of Monte Carlo samples to use for selection
+        :param n: the number of Monte Carlo samples to use for estimation
+        :param alpha: the failure probability
+        :param batch_size: batch size to use when evaluating the base classifier
+        :return: a list of (predicted class, certified radius), one for each input
+        """
+        return self.certify_sweep(xs, n0, n, alpha, batch_size)[0]
+
+    def certify_sweep(self, xs: torch.tensor, n0: int, n: int, alpha: float, batch_size: int) -> list:
+        """ Certify several inputs for every eta_float in self.eta_floats, all settings share the same noise.
+
+        :return: for each eta_float setting, a list of (predicted class, certified radius) for each input
+        """
+        self.base_classifier.eval()
+        self.anchors = self._anchor_pattern(xs)
+        self.dual_net.reset_stats(len(xs))
+        try:
+            counts_selection = self._sample_counts(xs, n0, batch_size)
+            counts_estimation = self._sample_counts(xs, n, batch_size)
+        finally:
+            self.fixed_ratio = self.dual_net.fixed_ratio()
+            self.dual_net.reset_stats(0)
+            self.anchors = None
+        res = []
+        for cAHats, setting_counts in zip(counts_selection.argmax(axis=2), counts_estimation):
+            setting_res = []
+            for cAHat, counts in zip(cAHats, setting_counts):
+                pABar = self._lower_confidence_bound(counts[cAHat].item(), n, alpha)
+                if pABar < 0.5:
+                    setting_res.append((Smooth.ABSTAIN, 0.0))
+                else:
+                    setting_res.append((cAHat.item(), self.sigma * norm.ppf(pABar)))
+            res.append(setting_res)
+        return res
 
     def _sample_noise(self, x: torch.tensor, num: int, batch_size) -> np.ndarray:
         """ Sample the base classifier's prediction under noisy corruptions of the input x.
@@ -22,19 +71,56 @@ class SCRFP(Smooth):
         :param x: the input [channel x width x height]
         :param num: number of samples to collect
         :param batch_size:
-        :return: an ndarray[int] of length num_classes containing the per-class counts
+        :return: an ndarray[int] of length num_classes containing the per-class counts (of the first eta_float)
+        """
+        return self._sample_counts(x.unsqueeze(0), num, batch_size)[0, 0]
+
+    def _sample_counts(self, xs: torch.tensor, num: int, batch_size) -> np.ndarray:
+        """ Sample the base classifier's predictions for several inputs and eta_float settings in the same batches.
+
+        The batches only hold noisy samples, each row is compared against the cached activation pattern of its
+        input (computed once per certification, see DualNet.anchor_pattern). DualNet expands the batch to one copy
+        per setting at the first activation.
+
+        :param xs: the inputs [num_inputs x channel x width x height]
+        :param num: number of samples to collect for each input
+        :param batch_size: number of rows in one batch, shared by all inputs and settings
+        :return: an ndarray[int] of shape [num_settings x num_inputs x num_classes] containing the per-class counts
         """
         self.dual_net.eval()
+        num_inputs, num_settings = len(xs), len(self.eta_floats)
+        per_input = max(batch_size // (num_inputs * num_settings), 1)
+        if num_settings > 1:
+            eta_float = torch.tensor(self.eta_floats, device=xs.device)
+        else:
+            eta_float = self.eta_floats[0]
+        anchors = self.anchors if self.anchors is not None else self._anchor_pattern(xs)
         with torch.no_grad():
-            counts = np.zeros(self.num_classes, dtype=int)
-            for _ in range(ceil(num / batch_size)):
-                this_batch_size = min(batch_size, num)
+            counts = np.zeros((num_settings, num_inputs, self.num_classes), dtype=int)
+            for _ in range(ceil(num / per_input)):
+                this_batch_size = min(per_input, num)
                 num -= this_batch_size
 
-                batch = x.repeat((this_batch_size + 1, 1, 1, 1))
-                n = torch.randn_like(x).to(x.device) * self.sigma
-                n[0] = 0
-                # batch = self.reverse_noise(batch)
-                predictions = self.dual_net.predict(batch+n, 0.0, self.args.eta_float)[1:]
-                counts += self._count_arr(predictions.argmax(1).cpu().numpy(), self.num_classes)
+                batch = xs.repeat_interleave(this_batch_size, dim=0)
+                if num_inputs > 1:
+                    segment_ids = torch.arange(num_inputs, device=xs.device).repeat_interleave(this_batch_size)
+                else:
+                    segment_ids = None
+                n = torch.randn_like(batch) * self.sigma
+                predictions = self.dual_net.predict(batch + n, 0.0, eta_float, segment_ids, anchors)
+                predictions = predictions.argmax(1).view(num_settings, num_inputs, this_batch_size)
+                counts += self._count_segments(predictions.cpu().numpy(), self.num_classes)
             return counts
+
+    def _anchor_pattern(self, xs):
+        self.dual_net.eval()
+        with torch.no_grad():
+            return self.dual_net.anchor_pattern(xs, 0.0)
+
+    @staticmethod
+    def _count_segments(arr: np.ndarray, length: int) -> np.ndarray:
+        # per-class counts along the last axis of arr, for every leading index
+        rows = arr.reshape(-1, arr.shape[-1])
+        offsets = np.arange(len(rows))[:, None] * length
+        counts = np.bincount((rows + offsets).ravel(), minlength=len(rows) * length)
+        return counts.reshape(arr.shape[:-1] + (length,))
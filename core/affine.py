@@ -0,0 +1,151 @@
+import torch.fx as fx
+
+from core.DualNet import DualNet, MaskScale, MaskedAct
+from models.blocks import *
+
+# activations that are linear on each side of the breakpoint 0, their slopes are constant where the pattern is fixed
+PIECEWISE_LINEAR = [nn.ReLU, nn.LeakyReLU, nn.Identity]
+
+
+class AffineShortcut(object):
+    """
+    Experimental DualNet predict for the models/dnn MLP and the models/mini VGG.
+
+    The trailing LinearBlocks of net.layers (the head) are one affine map of their input as long as a sample keeps
+    the activation pattern of the clean anchor. The pre-activations of every head layer are composed at the anchor
+    once, so that one stacked matmul of the noise delta gives the pre-activations of all head layers for a batch.
+    A row uses this result up to the first head layer where its pattern differs from the anchor, and goes through
+    the masked blocks from there, as DualNet.predict(x, 0, eta_float) would. The trunk (convolutions of the VGG)
+    always goes through DualNet.
+    """
+
+    def __init__(self, dual_net: DualNet):
+        self.dual_net = dual_net
+        net = dual_net.net
+        if not hasattr(net, 'layers') or not isinstance(net.layers, nn.Sequential):
+            raise NameError('AffineShortcut needs a model with a sequential net.layers (models/dnn, models/mini)')
+        if dual_net.gamma != [0]:
+            raise NameError('AffineShortcut needs a single breakpoint at 0')
+
+        # the head is the longest run of LinearBlocks at the end of net.layers
+        self.start = len(net.layers)
+        while self.start > 0 and type(net.layers[self.start - 1]) == LinearBlock:
+            self.start -= 1
+        self.blocks = list(net.layers)[self.start:]
+        if not self.blocks:
+            raise NameError('No LinearBlock at the end of net.layers')
+        for block in self.blocks:
+            if type(block.Act) not in PIECEWISE_LINEAR:
+                raise NameError('AffineShortcut does not support {}'.format(type(block.Act).__name__))
+        self.trunk = self._split_trunk()
+        # index of the masked activation of each head block in the anchor patterns, None without activation
+        self.act_layers, layer = [], len([m for m in self.trunk.modules() if type(m) == MaskedAct])
+        for block in self.blocks:
+            self.act_layers += [layer if check_activation(block.Act) else None]
+            layer += int(check_activation(block.Act))
+
+        # set by set_anchor
+        self.anchors = None
+        self.h_anchor, self.z_anchor, self.jacobian, self.sizes = None, None, None, None
+        # ratio of rows of the last predict whose head pattern is fully fixed (device tensor)
+        self.shortcut_ratio = None
+
+    def _split_trunk(self):
+        # copy the rewritten graph up to the input of the first head block
+        graph_module = self.dual_net.graph_net
+        prefix = 'layers.{}.'.format(self.start)
+        graph, env = fx.Graph(), {}
+        for node in graph_module.graph.nodes:
+            if node.op == 'call_module' and node.target.startswith(prefix):
+                graph.output(env[node.args[0]])
+                break
+            env[node] = graph.node_copy(node, lambda n: env[n])
+        return fx.GraphModule(graph_module, graph)
+
+    @staticmethod
+    def _fold(block):
+        # FC followed by BN in eval mode is one affine map z = A h + c
+        weight, bias = block.FC.weight, block.FC.bias
+        if bias is None:
+            bias = torch.zeros_like(weight[:, 0])
+        bn = block.BN
+        if type(bn) == nn.BatchNorm1d:
+            scale = torch.rsqrt(bn.running_var + bn.eps)
+            shift = -bn.running_mean * scale
+            if bn.weight is not None:
+                scale, shift = scale * bn.weight, shift * bn.weight + bn.bias
+            return scale[:, None] * weight, scale * bias + shift
+        return weight, bias
+
+    @staticmethod
+    def _slope(act, z):
+        if type(act) == nn.Identity:
+            return torch.ones_like(z)
+        negative_slope = act.negative_slope if type(act) == nn.LeakyReLU else 0.0
+        return torch.where(z > 0, torch.ones_like(z), torch.full_like(z, negative_slope))
+
+    def set_anchor(self, x):
+        """
+        Record the activation pattern of the clean input and compose the head at it
+        @param x: the clean input [1 x channel x height x width]
+        """
+        self.dual_net.eval()
+        with torch.no_grad():
+            self.anchors = self.dual_net.anchor_pattern(x, 0.0)
+            h = self.dual_net.run(None, x, net=self.trunk).flatten(1)
+            self.h_anchor = h
+            z_anchor, jacobians, jacobian = [], [], None
+            for block in self.blocks:
+                z = block.BN(block.FC(h))
+                h = block.Act(z.clone())
+                # d z_i / d h_0, the slopes of the anchor are applied before the next layer
+                a, _ = self._fold(block)
+                jacobian = a if jacobian is None else a @ jacobian
+                jacobians += [jacobian]
+                jacobian = jacobian * self._slope(block.Act, z[0])[:, None]
+                z_anchor += [z]
+            self.sizes = [z.shape[1] for z in z_anchor]
+            self.z_anchor = torch.cat(z_anchor, dim=1)
+            self.jacobian = torch.cat(jacobians)
+
+    def predict(self, x, eta_float):
+        """
+        Same output as DualNet.predict(x, 0.0, eta_float, anchors=...) for noisy samples of the anchor
+        @param x: noisy samples of the anchor [batch x channel x height x width]
+        @param eta_float: a single setting
+        """
+        if self.anchors is None:
+            raise ValueError('No anchor, see set_anchor')
+        with torch.no_grad():
+            h = self.dual_net.run('predict', x, net=self.trunk, eta_fixed=0.0, eta_float=eta_float, balance=False,
+                                  anchors=self.anchors, settings=1, rows=len(x)).flatten(1)
+            # pre-activations of all head layers, exact as long as the previous head layers keep the anchor pattern
+            zs = (self.z_anchor + (h - self.h_anchor) @ self.jacobian.T).split(self.sizes, dim=1)
+
+            # first head layer whose pattern differs from the anchor, len(self.blocks) if there is none
+            first = torch.full((len(x),), len(self.blocks), dtype=torch.long, device=x.device)
+            for i in reversed(range(len(self.blocks))):
+                if self.act_layers[i] is not None:
+                    fixed = self.dual_net.compute_fix_anchor(zs[i], self.anchors[self.act_layers[i]])
+                    first[~fixed.all(dim=1)] = i
+
+            self.shortcut_ratio = (first == len(self.blocks)).float().mean()
+            out = self.blocks[-1].Act(zs[-1].clone())
+            for k in torch.unique(first).tolist():
+                if k < len(self.blocks):
+                    rows = torch.nonzero(first == k).squeeze(1)
+                    out[rows] = self._fallback(zs[k][rows], k, eta_float)
+            return out
+
+    def _fallback(self, z, k, eta_float):
+        # masked blocks from the pre-activation of head layer k on
+        h = z
+        for i in range(k, len(self.blocks)):
+            block = self.blocks[i]
+            if i > k:
+                h = block.BN(block.FC(h))
+            if self.act_layers[i] is not None:
+                fixed = self.dual_net.compute_fix_anchor(h, self.anchors[self.act_layers[i]])
+                h = MaskScale.apply(h, fixed, 0.0, eta_float, False)
+            h = block.Act(h)
+        return h
@@ -0,0 +1,101 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+def radius_bins(correct, radius, radii):
+    """
+    Bin of every image on a sorted radius grid: a correct image with certified radius R counts at the grid radii
+    r <= R, i.e. at the first bin radii, an incorrect image at none of them
+    @return: int64 [images], in [0, len(radii)]
+    """
+    return np.where(np.asarray(correct).astype(bool), np.searchsorted(radii, radius, side='right'), 0)
+
+
+def bin_curve(counts, images):
+    """
+    @param counts: [... x (num_radii + 1)] number of images in every radius bin
+    @return: [... x num_radii], certified accuracy at the grid radii (the images with bin > j at radius j)
+    """
+    return np.flip(np.cumsum(np.flip(counts[..., 1:], -1), axis=-1), -1) / max(images, 1)
+
+
+def _resample_curves(bins, num_radii, num_resamples, seed):
+    """
+    @param bins: [runs x images] radius bins of runs certified on the same images
+    @return: [num_resamples x runs x num_radii], the certified accuracy curves of the resampled image sets
+    """
+    runs, images = bins.shape
+    rng = np.random.default_rng(seed)
+    samples = rng.integers(0, images, size=(num_resamples, images))
+    curves = np.empty((num_resamples, runs, num_radii))
+    offsets = np.arange(num_resamples)[:, None] * (num_radii + 1)
+    for k in range(runs):
+        # number of resampled images in every bin of every resample, one bincount for the whole batch
+        counts = np.bincount((offsets + bins[k][samples]).ravel(), minlength=num_resamples * (num_radii + 1))
+        curves[:, k] = bin_curve(counts.reshape(num_resamples, num_radii + 1), images)
+    return curves
+
+
+class Bootstrap:
+    """
+    Percentile bootstrap of certified accuracy curves. Images are resampled with replacement num_resamples times,
+    the curves of a batch of resamples come from one bincount over the radius bins of the images. Batches run in a
+    process pool, each with its own child of the SeedSequence so that the result only depends on seed.
+    """
+
+    def __init__(self, num_resamples=1000, confidence=0.95, seed=0, workers=None, batch=100):
+        self.num_resamples = num_resamples
+        self.confidence = confidence
+        self.seed = seed
+        self.workers = workers or os.cpu_count() or 1
+        self.batch = batch
+
+    def curves(self, bins, num_radii):
+        """
+        @param bins: [runs x images] radius bins, see radius_bins
+        @return: [num_resamples x runs x num_radii]
+        """
+        bins = np.asarray(bins, dtype=np.int64)
+        sizes = [min(self.batch, self.num_resamples - i) for i in range(0, self.num_resamples, self.batch)]
+        seeds = np.random.SeedSequence(self.seed).spawn(len(sizes))
+        if self.workers == 1 or len(sizes) == 1:
+            return np.concatenate([_resample_curves(bins, num_radii, s, seed) for s, seed in zip(sizes, seeds)])
+        with ProcessPoolExecutor(min(self.workers, len(sizes))) as pool:
+            parts = pool.map(_resample_curves, [bins] * len(sizes), [num_radii] * len(sizes), sizes, seeds)
+            return np.concatenate(list(parts))
+
+    def interval(self, values):
+        """
+        @return: lower and upper percentiles of values along the first axis
+        """
+        tail = (1 - self.confidence) / 2 * 100
+        return np.percentile(values, tail, axis=0), np.percentile(values, 100 - tail, axis=0)
+
+    def band(self, correct, radius, radii):
+        """
+        @return: (curve, lower, upper), certified accuracy at radii and its confidence band
+        """
+        radii = np.asarray(radii)
+        bins = radius_bins(correct, radius, radii)
+        curve = bin_curve(np.bincount(bins, minlength=len(radii) + 1), len(bins))
+        lower, upper = self.interval(self.curves(bins[None], len(radii))[:, 0])
+        return curve, lower, upper
+
+    def paired_difference(self, run_a, run_b, radii):
+        """
+        Difference of the curves of two runs certified on the same images, resampling the images of both together
+        @param run_a, run_b: (idx, correct, radius) arrays of each run, the images are matched by idx
+        @return: (difference, lower, upper), curve of run_a minus curve of run_b and its confidence band
+        """
+        radii = np.asarray(radii)
+        common, pos_a, pos_b = np.intersect1d(run_a[0], run_b[0], return_indices=True)
+        if len(common) == 0:
+            raise ValueError('The two runs have no image in common')
+        bins = np.stack([radius_bins(run_a[1][pos_a], run_a[2][pos_a], radii),
+                         radius_bins(run_b[1][pos_b], run_b[2][pos_b], radii)])
+        full = bin_curve(np.stack([np.bincount(b, minlength=len(radii) + 1) for b in bins]), len(common))
+        curves = self.curves(bins, len(radii))
+        lower, upper = self.interval(curves[:, 0] - curves[:, 1])
+        return full[0] - full[1], lower, upper
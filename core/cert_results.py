@@ -0,0 +1,162 @@
+import datetime
+import glob
+import json
+import os
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+# column types of a certification result, time is in seconds
+COLUMNS = {'idx': np.int64, 'label': np.int64, 'predict': np.int64, 'radius': np.float64, 'correct': np.int64,
+           'time': np.float64, 'samples': np.int64, 'precert': np.float64, 'skipped': np.int64}
+# columns of the tab-separated results written by smooth_pred
+TSV_COLUMNS = ['idx', 'label', 'predict', 'radius', 'correct', 'time']
+# prefix of the comment line holding the metadata of a run in an exported tab-separated file
+META_PREFIX = '# meta: '
+
+
+def format_seconds(seconds):
+    return str(datetime.timedelta(seconds=float(seconds)))
+
+
+def parse_seconds(text):
+    """ Inverse of format_seconds, e.g. '0:00:01.500000' or '1 day, 2:03:04' """
+    match = re.fullmatch(r'(?:(-?\d+) days?, )?(\d+):(\d+):(\d+(?:\.\d+)?)', text.strip())
+    if match is None:
+        raise ValueError('Not a time delta: {}'.format(text))
+    days, hours, minutes, seconds = match.groups()
+    return datetime.timedelta(days=int(days or 0), hours=int(hours), minutes=int(minutes),
+                              seconds=float(seconds)).total_seconds()
+
+
+class ResultWriter:
+    """
+    Append certification results to a columnar store: a directory with meta.json (configuration and columns) and
+    chunk_{k}.npz files of typed column arrays. A chunk is written every chunk_rows rows or every flush_seconds,
+    whichever comes first, so that a partial run stays readable and a crash loses little work; close writes the
+    last rows.
+    """
+
+    def __init__(self, path: str, meta: dict = None, columns: list = None, chunk_rows: int = 256,
+                 flush_seconds: float = 300):
+        self.path = path
+        self.columns = columns or TSV_COLUMNS + ['samples']
+        self.chunk_rows = chunk_rows
+        self.flush_seconds = flush_seconds
+        self.last_flush = time.time()
+        os.makedirs(path, exist_ok=True)
+        for chunk in glob.glob(os.path.join(path, 'chunk_*.npz')):
+            os.remove(chunk)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'columns': self.columns, 'meta': meta or {}}, f, default=str)
+        self.rows = []
+        self.num_chunks = 0
+
+    def append(self, **row):
+        self.rows.append([row[c] for c in self.columns])
+        if len(self.rows) >= self.chunk_rows or time.time() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.time()
+        if not self.rows:
+            return
+        columns = list(zip(*self.rows))
+        arrays = {c: np.array(v, dtype=COLUMNS.get(c, np.float64)) for c, v in zip(self.columns, columns)}
+        np.savez(os.path.join(self.path, 'chunk_{:06d}.npz'.format(self.num_chunks)), **arrays)
+        self.num_chunks += 1
+        self.rows = []
+
+    def close(self):
+        self.flush()
+
+
+class TSVResultWriter:
+    """ Same interface as ResultWriter, writes the tab-separated format of smooth_pred """
+
+    def __init__(self, path: str, columns: list = None):
+        self.columns = columns or TSV_COLUMNS
+        self.f = open(path, 'w')
+        print('\t'.join(self.columns), file=self.f, flush=True)
+
+    def append(self, **row):
+        fields = []
+        for c in self.columns:
+            if c in ['radius', 'precert']:
+                fields.append('{:.3}'.format(row[c]))
+            elif c == 'time':
+                fields.append(format_seconds(row[c]))
+            else:
+                fields.append(str(row[c]))
+        print('\t'.join(fields), file=self.f, flush=True)
+
+    def close(self):
+        self.f.close()
+
+
+def is_result_store(path: str) -> bool:
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'meta.json'))
+
+
+def read_results(path: str, columns: list = None):
+    """
+    Read a results store (ResultWriter) or a tab-separated results file
+    @param columns: the columns to read, all of them if None; the ones missing from the file are left out
+    @return: dict of column arrays, and the metadata of the run ({} for a tsv file written by smooth_pred)
+    """
+    if is_result_store(path):
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            info = json.load(f)
+        chunks = [np.load(chunk) for chunk in sorted(glob.glob(os.path.join(path, 'chunk_*.npz')))]
+        data = {c: np.concatenate([chunk[c] for chunk in chunks]) if chunks else np.zeros(0, COLUMNS.get(c, float))
+                for c in info['columns'] if columns is None or c in columns}
+        return data, info['meta']
+    # exported files start with the metadata of the run on a comment line
+    meta = {}
+    with open(path, 'r') as f:
+        first = f.readline()
+    if first.startswith(META_PREFIX):
+        meta = json.loads(first[len(META_PREFIX):])
+    df = pd.read_csv(path, delimiter='\t', usecols=None if columns is None else lambda c: c in columns,
+                     skiprows=1 if meta else 0)
+    data = {}
+    for c in df.columns:
+        if c == 'time':
+            data[c] = np.array([parse_seconds(t) for t in df[c]], dtype=np.float64)
+        else:
+            data[c] = df[c].to_numpy(dtype=COLUMNS.get(c, np.float64))
+    return data, meta
+
+
+def tsv_to_results(tsv_path: str, path: str, meta: dict = None):
+    """ Convert a tab-separated results file to a results store, with the metadata of the file if meta is None """
+    data, tsv_meta = read_results(tsv_path)
+    writer = ResultWriter(path, tsv_meta if meta is None else meta, list(data.keys()),
+                          chunk_rows=max(len(data['idx']), 1), flush_seconds=float('inf'))
+    for values in zip(*data.values()):
+        writer.append(**dict(zip(data.keys(), values)))
+    writer.close()
+
+
+def results_to_tsv(path: str, tsv_path: str):
+    """
+    Convert a results store to a tab-separated file, floats are written with repr and the metadata on a first
+    comment line, so that nothing is lost
+    """
+    data, meta = read_results(path)
+    with open(tsv_path, 'w') as f:
+        if meta:
+            print(META_PREFIX + json.dumps(meta), file=f)
+        print('\t'.join(data.keys()), file=f)
+        for values in zip(*data.values()):
+            fields = []
+            for c, v in zip(data.keys(), values):
+                if c == 'time':
+                    fields.append(format_seconds(v))
+                elif np.issubdtype(type(v), np.floating):
+                    fields.append(repr(float(v)))
+                else:
+                    fields.append(str(v))
+            print('\t'.join(fields), file=f)
@@ -0,0 +1,177 @@
+import torch.nn.functional as F
+
+from core.pattern import retrieve_lb_ub
+from models.base_model import NormalizeLayer
+from models.blocks import *
+
+
+def derivative_masks(stored_values, grad_bound):
+    """
+    Largest absolute derivative of every neuron allowed by its recorded regions (see retrieve_lb_ub)
+    @param stored_values: recorder of a ModelHook over the samples of one image
+    @param grad_bound: derivative bounds of each region, see set_lb_ub
+    @return: one tensor [...] for each hooked activation, in the order of the blocks of the model
+    """
+    net_lb, net_ub = retrieve_lb_ub(stored_values, grad_bound)
+    return [torch.tensor(np.maximum(np.abs(lb), np.abs(ub)), dtype=torch.float)
+            for block_lb, block_ub in zip(net_lb, net_ub) for lb, ub in zip(block_lb, block_ub)]
+
+
+class LipschitzBound:
+    """
+    L2 Lipschitz upper bound of the models/dnn MLP and the models/mini VGG on the region where every neuron keeps
+    its derivative within the recorded bounds.
+
+    Each LinearBlock / ConvBlock is the (BN folded) operator A followed by an activation whose derivative is at most
+    m per neuron, so the Jacobian of the block is bounded by ||diag(m) A||_2. Pooling and flattening layers are
+    1-Lipschitz, the input normalization scales by 1 / min(std).
+
+    bound takes ||B||_2, B = diag(m) A, exactly for the LinearBlocks (a batched SVD of the small matrices B). For
+    the ConvBlocks, whose matrix is too large, it takes the smaller of two guaranteed upper bounds: the Frobenius
+    norm and sqrt(||B||_1 ||B||_inf) (largest absolute column sum times largest absolute row sum), both computed
+    with |A| in one forward / adjoint pass. These are loose: on a small 5-conv mini VGG with random masks they were
+    3 to 5 times ||B||_2 (explicit Jacobian) for every conv block, and the looseness multiplies over the blocks. estimate uses power iteration on every
+    block, for a batch of images at once (one mask per image) warm-started from the singular vectors of the
+    previous batch: it is tighter but approaches ||B||_2 from below, so it is not an upper bound.
+    """
+
+    def __init__(self, net, input_shape, iters=20):
+        self.net = net
+        self.iters = iters
+        self.blocks, self.in_shapes = [], []
+        self.scale = 1.0
+
+        # input shape of every block, and whether the input is normalized, from one forward
+        handles = [m.register_forward_hook(self._record) for m in net.modules()
+                   if type(m) in [LinearBlock, ConvBlock, NormalizeLayer]]
+        was_training = net.training
+        net.eval()
+        param = next(net.parameters())
+        with torch.no_grad():
+            net(torch.zeros((1,) + tuple(input_shape), device=param.device, dtype=param.dtype))
+        net.train(was_training)
+        for handle in handles:
+            handle.remove()
+
+        # index of the activation of each block in the masks, None for blocks without activation
+        self.act_index, index = [], 0
+        for block in self.blocks:
+            self.act_index += [index if check_activation(block.Act) else None]
+            index += int(check_activation(block.Act))
+
+        # singular vectors of the last batch, to warm-start the next one
+        self.vectors = [None] * len(self.blocks)
+
+    def _record(self, module, input_var, output_var):
+        if type(module) == NormalizeLayer:
+            self.scale = 1 / module.sds.min().item()
+        else:
+            self.blocks.append(module)
+            self.in_shapes.append(tuple(input_var[0].shape[1:]))
+
+    @staticmethod
+    def _bn_scale(block, out_channels, like):
+        # scale of the folded BN, on the device and in the dtype of like
+        bn = block.BN
+        if type(bn) in [nn.BatchNorm1d, nn.BatchNorm2d]:
+            scale = torch.rsqrt(bn.running_var + bn.eps)
+            return scale * bn.weight if bn.weight is not None else scale
+        return like.new_ones(out_channels)
+
+    @staticmethod
+    def _entries(x, power):
+        # the operator itself, or its entry-wise |.| ** power
+        return x if power is None else x.abs() ** power
+
+    def _forward(self, block, v, power=None):
+        if type(block) == LinearBlock:
+            weight = self._entries(block.FC.weight, power)
+            return F.linear(v, weight) * self._entries(self._bn_scale(block, weight.shape[0], v), power)
+        conv = block.Conv
+        a = self._entries(self._bn_scale(block, conv.out_channels, v), power)
+        weight = self._entries(conv.weight, power)
+        return F.conv2d(v, weight, None, conv.stride, conv.padding, conv.dilation, conv.groups) * a.view(-1, 1, 1)
+
+    def _adjoint(self, block, u, in_shape, power=None):
+        if type(block) == LinearBlock:
+            weight = self._entries(block.FC.weight, power)
+            return F.linear(u * self._entries(self._bn_scale(block, weight.shape[0], u), power), weight.t())
+        conv = block.Conv
+        u = u * self._entries(self._bn_scale(block, conv.out_channels, u), power).view(-1, 1, 1)
+        # output padding recovers the input size lost by the stride
+        output_padding = [size - ((out - 1) * s - 2 * p + d * (k - 1) + 1) for size, out, s, p, d, k in
+                          zip(in_shape[1:], u.shape[2:], conv.stride, conv.padding, conv.dilation, conv.kernel_size)]
+        return F.conv_transpose2d(u, self._entries(conv.weight, power), None, conv.stride, conv.padding,
+                                  output_padding, conv.groups, conv.dilation)
+
+    def upper_norms(self, masks):
+        """
+        @param masks: one tensor [images x ...] of non-negative derivative bounds for each hooked activation
+        @return: [images x num_blocks], ||diag(m) A||_2 of every LinearBlock and a guaranteed upper bound of it for
+                 every ConvBlock, for every image (at least in float32, the SVD has no half precision)
+        """
+        images = len(masks[0])
+        norms = []
+        with torch.no_grad():
+            for i, (block, in_shape) in enumerate(zip(self.blocks, self.in_shapes)):
+                param = next(block.parameters())
+                dtype = torch.promote_types(param.dtype, torch.float32)
+                out_shape = self._forward(block, param.new_zeros((1,) + in_shape)).shape[1:]
+                if self.act_index[i] is not None:
+                    m = masks[self.act_index[i]].to(param.device, param.dtype).abs().expand((images,) + out_shape)
+                else:
+                    m = param.new_ones((images,) + out_shape)
+                if type(block) == LinearBlock:
+                    weight = block.FC.weight * self._bn_scale(block, block.FC.out_features, param)[:, None]
+                    norms.append(torch.linalg.matrix_norm(m.to(dtype)[..., None] * weight.to(dtype), 2))
+                    continue
+                ones = param.new_ones((1,) + in_shape)
+                # absolute row sums and squared row norms of A, one value per output neuron
+                rows, rows_sq = self._forward(block, ones, power=1), self._forward(block, ones, power=2)
+                # absolute column sums of diag(m) A, one value per input neuron
+                cols = self._adjoint(block, m, in_shape, power=1)
+                holder = ((rows * m).flatten(1).amax(dim=1) * cols.flatten(1).amax(dim=1)).sqrt()
+                frobenius = (rows_sq * m * m).flatten(1).sum(dim=1).sqrt()
+                norms.append(torch.minimum(holder, frobenius).to(dtype))
+        return torch.stack(norms, dim=1)
+
+    def block_norms(self, masks):
+        """
+        Power iteration estimate of ||diag(m) A||_2, from below
+        @param masks: one tensor [images x ...] of derivative bounds for each hooked activation
+        @return: [images x num_blocks], the estimate of every block for every image
+        """
+        images = len(masks[0])
+        norms = []
+        with torch.no_grad():
+            for i, (block, in_shape) in enumerate(zip(self.blocks, self.in_shapes)):
+                param = next(block.parameters())
+                m = masks[self.act_index[i]].to(param.device, param.dtype) if self.act_index[i] is not None else None
+                if self.vectors[i] is None:
+                    v = torch.randn((images,) + in_shape, device=param.device, dtype=param.dtype)
+                else:
+                    v = self.vectors[i].expand((images,) + in_shape).clone()
+                for _ in range(self.iters):
+                    v = v / v.flatten(1).norm(dim=1).clamp_min(1e-12).view((-1,) + (1,) * len(in_shape))
+                    u = self._forward(block, v)
+                    u = u * m * m if m is not None else u
+                    v = self._adjoint(block, u, in_shape)
+                v = v / v.flatten(1).norm(dim=1).clamp_min(1e-12).view((-1,) + (1,) * len(in_shape))
+                u = self._forward(block, v)
+                u = u * m if m is not None else u
+                norms.append(u.flatten(1).norm(dim=1))
+                self.vectors[i] = v[:1]
+        return torch.stack(norms, dim=1)
+
+    def bound(self, masks):
+        """
+        @param masks: one tensor [images x ...] of derivative bounds for each hooked activation, see derivative_masks
+        @return: [images], the L2 Lipschitz upper bound of every image
+        """
+        return self.scale * self.upper_norms(masks).prod(dim=1)
+
+    def estimate(self, masks):
+        """
+        @return: [images], the power iteration estimate of the Lipschitz constant of every image, not an upper bound
+        """
+        return self.scale * self.block_norms(masks).prod(dim=1)
@@ -1,12 +1,23 @@
+from collections import deque
+
 from models.blocks import *
 
 
 class ModelHook:
-    def __init__(self, model, hook, *args, **kwargs):
+    """
+    Forward hooks on every activation of the LinearBlocks / ConvBlocks of the model. The hooks are registered once,
+    each one writes into its own deque (a ring buffer of the last maxlen values if maxlen is given), which is
+    emptied in place by reset.
+    """
+
+    def __init__(self, model, hook, *args, maxlen=None, **kwargs):
         self.model = model
         self.hook = hook
         self.args = args
         self.kwargs = kwargs
+        self.maxlen = maxlen
+        # the hooks return immediately while disabled
+        self.enabled = True
 
         self.stored_values = {}
         self.handles = []
@@ -24,23 +35,48 @@ class ModelHook:
     def add_block_hook(self, block, storage):
         for module_name, module in block.named_modules():
             if check_activation(module):
-                storage[module_name] = []
+                storage[module_name] = deque(maxlen=self.maxlen)
                 self.handles.append(module.register_forward_hook(
-                    self.hook(storage[module_name], *self.args, **self.kwargs))
+                    self._switch(self.hook(storage[module_name], *self.args, **self.kwargs)))
                 )
 
+    def _switch(self, hook):
+        def switched(layer, input_var, output_var):
+            if self.enabled:
+                hook(layer, input_var, output_var)
+
+        return switched
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        # empty the storage in place, the hooks keep writing into the same deques
+        for block in self.stored_values.values():
+            for layer in block.values():
+                if len(layer) == 1 and type(layer[0]) == PatternBuffer:
+                    # keep the device buffer of set_compact_pattern_hook, only its samples are dropped
+                    layer[0].reset()
+                else:
+                    layer.clear()
+
     def remove(self):
         for handle in self.handles:
             handle.remove()
+        self.handles = []
         self.stored_values = {}
 
     def retrieve_res(self, fun=None, reset=True, *args, **kwargs):
         if fun is not None:
             res = fun(self.stored_values, *args, **kwargs)
         else:
-            res = self.stored_values
+            res = {name: {k: [v.snapshot() if type(v) == PatternBuffer else v for v in layer]
+                          for k, layer in block.items()} for name, block in self.stored_values.items()}
         if reset:
-            self.set_up()
+            self.reset()
         return res
 
 
@@ -91,23 +127,205 @@ def set_pattern_hook(stored_values, Gamma):
     """
 
     def hook(layer, input_var, output_var):
-        input_var = input_var[0].cpu().detach()
-        pattern = get_pattern(input_var, Gamma)
-        stored_values.append(pattern)
+        pattern = get_pattern(input_var[0].detach(), Gamma)
+        stored_values.append(to_numpy(pattern))
 
     return hook
 
 
-def get_pattern(input_var, Gamma):
-    pattern = np.zeros(input_var.shape)
-    num_of_pattern = len(Gamma)
+def set_device_pattern_hook(stored_values, Gamma):
+    """
+    Record the int8 activation pattern of this layer, kept on the device for statistics computed there
+    @param stored_values: recorder
+    @param Gamma: A set of breakpoints, see set_pattern_hook
+    @return: activation hook
+    """
+
+    def hook(layer, input_var, output_var):
+        stored_values.append(get_pattern(input_var[0].detach(), Gamma))
+
+    return hook
+
+
+def set_compact_pattern_hook(stored_values, Gamma, capacity=4096, packed=True):
+    r"""
+    Record the activation pattern of each neuron at this layer on the device, see PatternBuffer.
+    The pattern is the same as set_pattern_hook, stored as int8 (or one bit per neuron if Gamma has one breakpoint
+    and packed is set) instead of float64, and copied to the host in chunks of capacity samples.
+    @param stored_values: recorder, holds a single PatternBuffer once the hook has been called
+    @param Gamma: A set of breakpoints, see set_pattern_hook
+    @param capacity: number of samples kept on the device before they are copied to the host
+    @param packed: pack the pattern to bits for a single breakpoint
+    @return: activation hook
+    """
+
+    def hook(layer, input_var, output_var):
+        if len(stored_values) == 0:
+            stored_values.append(PatternBuffer(Gamma, capacity, packed))
+        stored_values[0].append(input_var[0].detach())
+
+    return hook
+
+
+class PatternBuffer:
+    """
+    Activation patterns of one layer, computed on the device and written into a preallocated device buffer.
+    A full buffer is copied to pinned host memory without blocking the host, result gathers the copies.
+    """
+
+    def __init__(self, Gamma, capacity=4096, packed=True):
+        self.Gamma = Gamma
+        self.capacity = capacity
+        self.packed = packed and len(Gamma) == 1
+
+        # allocated at the first append, when the shape and device are known
+        self.shape, self.buffer = None, None
+        self.num = 0
+        self.chunks = []
+
+    def append(self, input_var):
+        if self.buffer is None:
+            self.shape = tuple(input_var.shape[1:])
+            row = ((int(np.prod(self.shape)) + 7) // 8,) if self.packed else self.shape
+            self.buffer = torch.empty((self.capacity,) + row, dtype=torch.uint8 if self.packed else torch.int8,
+                                      device=input_var.device)
+        if self.packed:
+            pattern = pack_pattern(input_var > self.Gamma[0])
+        else:
+            pattern = get_pattern(input_var, self.Gamma)
+        start = 0
+        while start < len(pattern):
+            size = min(len(pattern) - start, self.capacity - self.num)
+            self.buffer[self.num: self.num + size] = pattern[start: start + size]
+            self.num += size
+            start += size
+            if self.num == self.capacity:
+                self.flush()
+
+    def flush(self):
+        if self.num == 0:
+            return
+        # ordered after the writes to the buffer on the same stream, the host does not wait for it
+        chunk = torch.empty(self.buffer[:self.num].shape, dtype=self.buffer.dtype,
+                            pin_memory=self.buffer.is_cuda)
+        chunk.copy_(self.buffer[:self.num], non_blocking=True)
+        self.chunks.append(chunk)
+        self.num = 0
+
+    def reset(self):
+        # drop the recorded samples, the device buffer is kept for the next ones
+        self.num = 0
+        self.chunks = []
+
+    def snapshot(self):
+        """
+        @return: a PatternBuffer holding the samples recorded so far, not affected by later appends and resets
+        """
+        self.flush()
+        copy = PatternBuffer(self.Gamma, self.capacity, self.packed)
+        # the device buffer is only kept to synchronize with the pending copies in result
+        copy.shape, copy.buffer, copy.chunks = self.shape, self.buffer, list(self.chunks)
+        return copy
+
+    def __len__(self):
+        return sum(len(chunk) for chunk in self.chunks) + self.num
+
+    def result(self, unpacked=True):
+        """
+        @param unpacked: unpack bit-packed patterns
+        @return: int8 ndarray [samples x ...] of region indices (uint8 [samples x bytes] if packed and not unpacked)
+        """
+        self.flush()
+        if self.buffer is not None and self.buffer.is_cuda:
+            torch.cuda.synchronize(self.buffer.device)
+        if not self.chunks:
+            return np.zeros((0,) + (self.shape or ()), dtype=np.int8)
+        res = torch.cat(self.chunks).numpy()
+        self.chunks = [torch.from_numpy(res)]
+        if self.packed and unpacked:
+            return unpack_pattern(res, self.shape)
+        return res
+
+
+def pack_pattern(pattern):
+    """
+    Pack a boolean pattern [samples x ...] to uint8 [samples x ceil(neurons / 8)], in the bit order of np.packbits
+    """
+    bits = pattern.reshape(len(pattern), -1)
+    pad = (-bits.shape[1]) % 8
+    if pad:
+        bits = torch.cat([bits, bits.new_zeros((len(bits), pad))], dim=1)
+    weights = torch.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8, device=bits.device)
+    return (bits.view(len(bits), -1, 8).to(torch.uint8) * weights).sum(dim=2, dtype=torch.uint8)
 
-    pattern[to_numpy(input_var < Gamma[0])] = 0
-    pattern[to_numpy(input_var > Gamma[-1])] = num_of_pattern
-    for i in range(1, num_of_pattern):
-        valid = pattern > Gamma[i] * pattern < Gamma[i + 1]
-        pattern[to_numpy(valid)] = i
-    return pattern
+
+def unpack_pattern(packed, shape):
+    """
+    Inverse of pack_pattern on the host
+    @return: int8 ndarray [samples x shape]
+    """
+    neurons = int(np.prod(shape))
+    bits = np.unpackbits(to_numpy(packed), axis=1)[:, :neurons]
+    return bits.astype(np.int8).reshape((len(bits),) + tuple(shape))
+
+
+def set_reduce_hook(stored_values, Gamma):
+    """
+    Keep the running per-neuron min / max region index of this layer instead of the patterns, see PatternReducer
+    @param stored_values: recorder, holds a single PatternReducer once the hook has been called
+    @param Gamma: A set of breakpoints, see set_pattern_hook
+    @return: activation hook
+    """
+
+    def hook(layer, input_var, output_var):
+        if len(stored_values) == 0:
+            stored_values.append(PatternReducer(Gamma))
+        stored_values[0].append(input_var[0].detach())
+
+    return hook
+
+
+class PatternReducer:
+    """
+    Running per-neuron min / max region index over all samples seen, O(neurons) memory on the device
+    """
+
+    def __init__(self, Gamma):
+        self.Gamma = Gamma
+        self.min, self.max = None, None
+        self.num = 0
+
+    def append(self, input_var):
+        pattern = get_pattern(input_var, self.Gamma)
+        batch_min, batch_max = pattern.amin(dim=0), pattern.amax(dim=0)
+        if self.min is None:
+            self.min, self.max = batch_min, batch_max
+        else:
+            self.min, self.max = torch.minimum(self.min, batch_min), torch.maximum(self.max, batch_max)
+        self.num += len(pattern)
+
+    @property
+    def changed(self):
+        # a neuron has changed its region at least once iff its min and max differ
+        return self.min != self.max
+
+    def __len__(self):
+        return self.num
+
+
+def get_pattern(input_var, Gamma):
+    """
+    Region index of every neuron, the number of breakpoints in Gamma strictly below the input (0 for x <= Gamma[0],
+    len(Gamma) for x > Gamma[-1]).
+    @param input_var: torch tensor on any device, or ndarray
+    @param Gamma: breakpoints
+    @return: int8 pattern of the same type, device and shape as input_var
+    """
+    if torch.is_tensor(input_var):
+        boundaries = torch.tensor(sorted(Gamma), dtype=input_var.dtype, device=input_var.device)
+        return torch.bucketize(input_var, boundaries, out_int32=True).to(torch.int8)
+    else:
+        return np.searchsorted(np.sort(Gamma), input_var, side='left').astype(np.int8)
 
 
 def get_similarity(pattern, Gamma):
@@ -126,26 +344,51 @@ def min_max_pattern(pattern, mode='min'):
 
 
 def unpack(stored_values):
-    unpacked = [[np.concatenate(layer)] if type(layer[0]) == np.ndarray else [torch.concat(layer)]
-                for block in stored_values.values() for layer in block.values()]
+    unpacked = [[concat_layer(layer)] for block in stored_values.values() for layer in block.values()]
     return unpacked
 
 
+def concat_layer(layer):
+    if type(layer[0]) == PatternBuffer:
+        return layer[0].result()
+    elif type(layer[0]) == np.ndarray:
+        return np.concatenate(list(layer))
+    else:
+        return torch.concat(list(layer))
+
+
 def retrieve_float_neurons(stored_values):
     """
-    calculate the float neurons of given pattern
-    @param stored_values: stored value from ModelHook
+    calculate the float neurons of given pattern, the neurons whose region is not the same for all samples
+    @param stored_values: stored value from ModelHook (patterns or PatternReducers)
     @return:
     """
-    unpacked = unpack(stored_values)
-    return [[np.all(layer - layer[0], axis=0) for layer in block]
-            for block in unpacked]
+    return [[min_pattern != max_pattern for min_pattern, max_pattern in block]
+            for block in retrieve_min_max(stored_values)]
+
+
+def retrieve_min_max(stored_values):
+    """
+    Per-neuron min / max region index of every recorded layer, nested as unpack
+    @param stored_values: stored value from ModelHook, with patterns or PatternReducers
+    @return: [[(min_pattern, max_pattern)], ...]
+    """
+    res = []
+    for block in stored_values.values():
+        for layer in block.values():
+            if type(layer[0]) == PatternReducer:
+                min_pattern, max_pattern = to_numpy(layer[0].min).astype(int), to_numpy(layer[0].max).astype(int)
+            else:
+                layer = concat_layer(layer)
+                min_pattern, max_pattern = min_max_pattern(layer, 'min'), min_max_pattern(layer, 'max')
+            res.append([(min_pattern, max_pattern)])
+    return res
 
 
 def retrieve_lb_ub(stored_values, grad_bound):
     r"""
     Compute the upper and lower derivative bound for the pattern
-    @param stored_values: recorder
+    @param stored_values: recorder, with patterns or PatternReducers (set_reduce_hook) for streaming samples
     @param grad_bound: A set of gradient bounds for each activation region with length #\Gamma + 1. For instance,
                         if activation is ReLU with Gamma=[0]
                             the grad bound should be [(0,0), (1,1)]
@@ -158,24 +401,13 @@ def retrieve_lb_ub(stored_values, grad_bound):
                 ]
     """
 
-    unpacked = unpack(stored_values)
-
-    # max_lambda = np.vectorize(lambda x: grad_bound[x][1])
-    # min_lambda = np.vectorize(lambda x: grad_bound[x][0])
-    #
-    # lb = [[[min_max_pattern(layer[i: i + sample_size], 'min')
-    #         for i in range(0, len(layer), sample_size)] for layer in block] for block in unpacked]
-    #
-    # ub = [[[min_max_pattern(layer[i: i + sample_size], 'max')
-    #         for i in range(0, len(layer), sample_size)] for layer in block] for block in unpacked]
-
     net_lb, net_ub = [], []
 
-    for block in unpacked:
+    for block in retrieve_min_max(stored_values):
         block_lb = []
         block_ub = []
-        for layer in block:
-            layer_lb, layer_ub = layer_lb_ub(layer, grad_bound)
+        for min_pattern, max_pattern in block:
+            layer_lb, layer_ub = min_max_lb_ub(min_pattern, max_pattern, grad_bound)
             block_lb.append(layer_lb)
             block_ub.append(layer_ub)
         net_lb.append(block_lb)
@@ -184,10 +416,12 @@ def retrieve_lb_ub(stored_values, grad_bound):
 
 
 def layer_lb_ub(layer, grad_bound):
-    layer_lb = np.zeros(layer.shape[1:])
-    layer_ub = np.zeros(layer.shape[1:])
-    min_pattern = min_max_pattern(layer, 'min')
-    max_pattern = min_max_pattern(layer, 'max')
+    return min_max_lb_ub(min_max_pattern(layer, 'min'), min_max_pattern(layer, 'max'), grad_bound)
+
+
+def min_max_lb_ub(min_pattern, max_pattern, grad_bound):
+    layer_lb = np.zeros(min_pattern.shape)
+    layer_ub = np.zeros(max_pattern.shape)
     for j, (lb, ub) in enumerate(grad_bound):
         layer_lb[min_pattern == j] = lb
         layer_ub[max_pattern == j] = ub
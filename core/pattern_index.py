@@ -0,0 +1,123 @@
+import numpy as np
+
+from core.pattern import PatternBuffer
+
+# number of set bits of every byte
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def hamming(packed, row):
+    """
+    Hamming distance between every bit-packed row of packed [n x bytes] and one bit-packed row [bytes]
+    """
+    return POPCOUNT[np.bitwise_xor(packed, row)].sum(axis=1, dtype=np.int64)
+
+
+def network_pattern(hook):
+    """
+    Bit-packed pattern of the whole network, the packed rows of every layer of a ModelHook
+    (set_compact_pattern_hook with a single breakpoint) side by side
+    @return: uint8 [samples x bytes]
+    """
+    buffers = [layer[0] for block in hook.stored_values.values() for layer in block.values()]
+    if not all(type(b) == PatternBuffer and b.packed for b in buffers):
+        raise ValueError('network_pattern needs bit-packed PatternBuffers, see set_compact_pattern_hook')
+    return np.concatenate([b.result(unpacked=False) for b in buffers], axis=1)
+
+
+class PatternIndex:
+    """
+    Locality-sensitive hash index of bit-packed activation patterns under the Hamming distance.
+
+    Each of the num_tables tables hashes a pattern to the bits_per_key bits it has at fixed random positions
+    (bit sampling). Two patterns at Hamming distance d out of n bits share a key with probability (1 - d / n) ** b,
+    so near patterns collide in at least one table with high probability while far ones rarely do. Every table is
+    a sorted array of keys, a query looks its keys up with a binary search and checks the candidates exactly.
+    """
+
+    def __init__(self, num_tables=16, bits_per_key=32, seed=0):
+        if bits_per_key > 64:
+            raise ValueError('bits_per_key must be at most 64')
+        self.num_tables = num_tables
+        self.bits_per_key = bits_per_key
+        self.rng = np.random.default_rng(seed)
+
+        # set at the first add, when the pattern length is known
+        self.positions = None
+        self.parts, self.patterns = [], None
+        self.keys, self.order = None, None
+
+    def __len__(self):
+        return sum(len(p) for p in self.parts)
+
+    def add(self, packed):
+        """
+        @param packed: bit-packed patterns uint8 [n x bytes], e.g. from pack_pattern or network_pattern
+        """
+        packed = np.ascontiguousarray(packed, dtype=np.uint8)
+        if self.positions is None:
+            num_bits = packed.shape[1] * 8
+            self.positions = np.stack([self.rng.choice(num_bits, self.bits_per_key, replace=num_bits < self.bits_per_key)
+                                       for _ in range(self.num_tables)])
+        self.parts.append(packed)
+        # the tables are rebuilt at the next query
+        self.patterns, self.keys, self.order = None, None, None
+
+    def build(self):
+        self.patterns = np.concatenate(self.parts) if len(self.parts) > 1 else self.parts[0]
+        self.parts = [self.patterns]
+        keys = self.hash(self.patterns)
+        self.order = np.argsort(keys, axis=0, kind='stable')
+        self.keys = np.take_along_axis(keys, self.order, axis=0)
+
+    def hash(self, packed):
+        """
+        @return: uint64 [n x num_tables], the sampled bits of every pattern for every table
+        """
+        keys = np.zeros((len(packed), self.num_tables), dtype=np.uint64)
+        # one sampled bit of every table at a time, the temporaries stay [n x num_tables]
+        for j in range(self.bits_per_key):
+            positions = self.positions[:, j]
+            bits = (packed[:, positions // 8] >> (7 - positions % 8).astype(np.uint8)) & 1
+            keys |= bits.astype(np.uint64) << np.uint64(j)
+        return keys
+
+    def candidates(self, row):
+        """
+        @return: ids of the patterns sharing a key with row in at least one table
+        """
+        if self.keys is None:
+            self.build()
+        keys = self.hash(row[None])[0]
+        found = []
+        for t in range(self.num_tables):
+            start = np.searchsorted(self.keys[:, t], keys[t], side='left')
+            stop = np.searchsorted(self.keys[:, t], keys[t], side='right')
+            found.append(self.order[start:stop, t])
+        return np.unique(np.concatenate(found))
+
+    def query(self, row, k):
+        """
+        Recorded patterns within Hamming distance k of row, found with high probability
+        @param row: one bit-packed pattern [bytes]
+        @param k: maximal Hamming distance
+        @return: (ids, distances), sorted by distance
+        """
+        row = np.asarray(row, dtype=np.uint8)
+        ids = self.candidates(row)
+        distances = hamming(self.patterns[ids], row)
+        keep = distances <= k
+        ids, distances = ids[keep], distances[keep]
+        order = np.argsort(distances, kind='stable')
+        return ids[order], distances[order]
+
+    def exact(self, row, k):
+        """
+        Brute-force reference of query
+        """
+        if self.keys is None:
+            self.build()
+        distances = hamming(self.patterns, np.asarray(row, dtype=np.uint8))
+        ids = np.nonzero(distances <= k)[0]
+        order = np.argsort(distances[ids], kind='stable')
+        return ids[order], distances[ids][order]
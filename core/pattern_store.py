@@ -0,0 +1,190 @@
+import json
+import os
+
+import numpy as np
+
+from core.pattern import PatternBuffer, unpack_pattern
+
+
+class PatternWriter:
+    """
+    Stream the activation patterns of every recorded layer into chunked, memory-mapped .npy files.
+
+    Rows are aligned across layers: row r of every layer and of the index belong to the same (sample, noise draw).
+    Files of a store at root:
+        meta.json               layers (name, shape, packed), chunk_size, number of rows
+        index_{chunk}.npy       int64 [chunk_size x 2], (sample, draw) of each row
+        {layer}_{chunk}.npy     int8 region indices [chunk_size x ...], or uint8 [chunk_size x bytes] if bit-packed
+    """
+
+    def __init__(self, root, chunk_size=65536):
+        self.root = root
+        self.chunk_size = chunk_size
+        os.makedirs(root, exist_ok=True)
+
+        self.layers = None
+        self.rows = 0
+        self.index, self.chunks = None, None
+
+    def write(self, patterns, sample_ids, draw_ids, names=None, shapes=None, packed=None):
+        """
+        @param patterns: one array [rows x ...] for each layer, int8 region indices or bit-packed uint8 rows
+        @param sample_ids: sample id of each row
+        @param draw_ids: noise draw id of each row
+        @param names, shapes, packed: layer names, pattern shapes (unpacked) and whether the rows are bit-packed,
+                                      only read at the first call
+        """
+        if self.layers is None:
+            names = names or [str(i) for i in range(len(patterns))]
+            shapes = shapes or [p.shape[1:] for p in patterns]
+            packed = packed or [False] * len(patterns)
+            self.layers = [{'name': n, 'shape': list(s), 'packed': bool(b), 'row': list(p.shape[1:]),
+                            'dtype': 'uint8' if b else 'int8'}
+                           for n, s, b, p in zip(names, shapes, packed, patterns)]
+        index = np.stack([np.asarray(sample_ids), np.asarray(draw_ids)], axis=1).astype(np.int64)
+        start = 0
+        while start < len(index):
+            offset = self.rows % self.chunk_size
+            if offset == 0:
+                self._open_chunk(self.rows // self.chunk_size)
+            size = min(len(index) - start, self.chunk_size - offset)
+            self.index[offset: offset + size] = index[start: start + size]
+            for chunk, pattern in zip(self.chunks, patterns):
+                chunk[offset: offset + size] = pattern[start: start + size]
+            self.rows += size
+            start += size
+
+    def write_hook(self, hook, sample_ids, draw_ids):
+        """
+        Write the PatternBuffers of a ModelHook (set_compact_pattern_hook) and reset them
+        """
+        names = ['{}.{}'.format(name, k) for name, block in hook.stored_values.items() for k in block.keys()]
+        layers = [layer for block in hook.stored_values.values() for layer in block.values()]
+        # rows are aligned across layers, a layer without any sample cannot be skipped
+        empty = [name for name, layer in zip(names, layers) if len(layer) == 0]
+        if empty:
+            raise ValueError('Layers {} recorded nothing, run the model before write_hook'.format(empty))
+        buffers = [layer[0] for layer in layers]
+        if not all(type(b) == PatternBuffer for b in buffers):
+            raise ValueError('write_hook needs a ModelHook with set_compact_pattern_hook')
+        patterns = [b.result(unpacked=False) for b in buffers]
+        self.write(patterns, sample_ids, draw_ids, names, [b.shape for b in buffers], [b.packed for b in buffers])
+        for b in buffers:
+            b.reset()
+
+    def _open_chunk(self, chunk):
+        self.flush()
+        self.index = np.lib.format.open_memmap(os.path.join(self.root, 'index_{}.npy'.format(chunk)), mode='w+',
+                                               dtype=np.int64, shape=(self.chunk_size, 2))
+        self.chunks = [np.lib.format.open_memmap(self._layer_file(self.root, i, chunk), mode='w+',
+                                                 dtype=layer['dtype'], shape=(self.chunk_size,) + tuple(layer['row']))
+                       for i, layer in enumerate(self.layers)]
+
+    @staticmethod
+    def _layer_file(root, layer, chunk):
+        return os.path.join(root, '{}_{}.npy'.format(layer, chunk))
+
+    def flush(self):
+        if self.index is not None:
+            self.index.flush()
+            for chunk in self.chunks:
+                chunk.flush()
+        meta = {'layers': self.layers, 'chunk_size': self.chunk_size, 'rows': self.rows}
+        with open(os.path.join(self.root, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    def close(self):
+        self.flush()
+        self.index, self.chunks = None, None
+
+
+class PatternReader:
+    """
+    Read a store written by PatternWriter, every array returned is a read-only view of the memory-mapped files.
+    The files are mapped once and kept open, the (sample, draw) -> row index is sorted once at the first lookup;
+    the store must not be written to while it is read.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.layers = meta['layers']
+        self.chunk_size = meta['chunk_size']
+        self.rows = meta['rows']
+
+        # memory maps of the index / layer files, opened at their first use
+        self._index, self._chunks = {}, {}
+        # rows sorted by (sample, draw), and their samples / draws, built at the first locate
+        self._order, self._samples, self._draws = None, None, None
+
+    def __len__(self):
+        return self.rows
+
+    @property
+    def num_chunks(self):
+        return (self.rows + self.chunk_size - 1) // self.chunk_size
+
+    def _rows_in(self, chunk):
+        return min(self.chunk_size, self.rows - chunk * self.chunk_size)
+
+    def index(self, chunk):
+        """
+        @return: int64 [rows x 2] view, (sample, draw) of the rows of the chunk
+        """
+        if chunk not in self._index:
+            data = np.load(os.path.join(self.root, 'index_{}.npy'.format(chunk)), mmap_mode='r')
+            self._index[chunk] = data[:self._rows_in(chunk)]
+        return self._index[chunk]
+
+    def chunk(self, layer, chunk):
+        """
+        @return: the stored rows of a layer in the chunk, bit-packed if the layer is packed
+        """
+        if (layer, chunk) not in self._chunks:
+            data = np.load(PatternWriter._layer_file(self.root, layer, chunk), mmap_mode='r')
+            self._chunks[(layer, chunk)] = data[:self._rows_in(chunk)]
+        return self._chunks[(layer, chunk)]
+
+    def iter_layer(self, layer, unpacked=True):
+        """
+        Lazily go through a layer chunk by chunk
+        @return: generator of (index [rows x 2], patterns [rows x ...])
+        """
+        for chunk in range(self.num_chunks):
+            data = self.chunk(layer, chunk)
+            if unpacked and self.layers[layer]['packed']:
+                data = unpack_pattern(data, self.layers[layer]['shape'])
+            yield self.index(chunk), data
+
+    def _build_lookup(self):
+        index = np.concatenate([self.index(chunk) for chunk in range(self.num_chunks)]) if self.rows \
+            else np.zeros((0, 2), dtype=np.int64)
+        # global row numbers sorted by sample, then draw, then row
+        self._order = np.lexsort((index[:, 1], index[:, 0]))
+        self._samples, self._draws = index[self._order, 0], index[self._order, 1]
+
+    def locate(self, sample, draw=None):
+        """
+        @return: global row numbers of a sample (and noise draw), in increasing order
+        """
+        if self._order is None:
+            self._build_lookup()
+        start = np.searchsorted(self._samples, sample, side='left')
+        stop = np.searchsorted(self._samples, sample, side='right')
+        if draw is not None:
+            draws = self._draws[start:stop]
+            start, stop = (start + np.searchsorted(draws, draw, side='left'),
+                           start + np.searchsorted(draws, draw, side='right'))
+        return np.sort(self._order[start:stop])
+
+    def get(self, sample, draw, layer, unpacked=True):
+        """
+        @return: pattern of one (sample, draw, layer), [rows x ...] (a single row unless the draw was written twice)
+        """
+        rows = self.locate(sample, draw)
+        data = [self.chunk(layer, row // self.chunk_size)[row % self.chunk_size] for row in rows]
+        data = np.stack(data) if data else np.zeros((0,) + tuple(self.layers[layer]['row']), dtype=self.layers[layer]['dtype'])
+        if unpacked and self.layers[layer]['packed']:
+            return unpack_pattern(data, self.layers[layer]['shape'])
+        return data
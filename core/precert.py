@@ -0,0 +1,145 @@
+import torch.nn.functional as F
+
+from core.affine import PIECEWISE_LINEAR
+from core.lip_bound import LipschitzBound
+from models.base_model import NormalizeLayer
+from models.blocks import *
+
+
+class PreCertifier:
+    """
+    Deterministic certificate of the base classifier (models/dnn MLP, models/mini VGG) around an anchor, without
+    sampling.
+
+    Inside the L2 ball where no neuron changes its sign and no max-pooling window changes its argmax, the network is
+    affine. A neuron with pre-activation z keeps its sign for radii below |z| / (||row|| * L), where row is its row of
+    the (BN folded) weight and L is a guaranteed upper bound of the Lipschitz constant of the part of the network
+    before its layer with the slopes of the anchor (LipschitzBound.upper_norms). A pooling window keeps its argmax
+    for radii below (first - second) / (2 * L); after a ReLU, a window whose maximum is 0 only holds inactive
+    neurons, which stay 0 inside the ball, so it does not bound the radius. Inside that ball the logits are affine,
+    so the prediction c is kept for radii below min_k (f_c - f_k) / ||grad (f_c - f_k)||.
+    """
+
+    # modules the certificate models, the network must be a sequence of them
+    SUPPORTED = [NormalizeLayer, ConvBlock, LinearBlock, nn.MaxPool2d, nn.Flatten, nn.AdaptiveAvgPool2d]
+
+    def __init__(self, net, input_shape, iters=20):
+        self.check_modules(net)
+        self.net = net
+        self.lip = LipschitzBound(net, input_shape, iters)
+        for block in self.lip.blocks:
+            if type(block.Act) not in PIECEWISE_LINEAR:
+                raise NameError('PreCertifier does not support {}'.format(type(block.Act).__name__))
+        self.pools = [m for m in net.modules() if type(m) == nn.MaxPool2d]
+        self.events = []
+
+    @classmethod
+    def check_modules(cls, module):
+        for name, child in module.named_children():
+            if type(child) == nn.Sequential:
+                cls.check_modules(child)
+            elif type(child) not in cls.SUPPORTED:
+                raise NameError('PreCertifier does not support {} ({})'.format(type(child).__name__, name))
+            elif type(child) == nn.MaxPool2d and (child.stride or child.kernel_size) != child.kernel_size:
+                # overlapping windows are not 1-Lipschitz
+                raise NameError('PreCertifier needs non-overlapping max-pooling ({})'.format(name))
+            elif type(child) == nn.AdaptiveAvgPool2d and child.output_size not in [1, (1, 1)]:
+                raise NameError('PreCertifier needs a global average pooling ({})'.format(name))
+
+    def _record(self, module, input_var):
+        # pre-hook, the activations are inplace
+        self.events.append((module, input_var[0].detach().clone()))
+
+    def anchor_events(self, x):
+        """
+        @return: logits, and the (module, input) of every block activation / max-pooling in forward order
+        """
+        self.events = []
+        handles = [block.Act.register_forward_pre_hook(self._record) for block in self.lip.blocks]
+        handles += [pool.register_forward_pre_hook(self._record) for pool in self.pools]
+        try:
+            with torch.no_grad():
+                out = self.net(x)
+        finally:
+            for handle in handles:
+                handle.remove()
+        events, self.events = self.events, []
+        return out, events
+
+    @staticmethod
+    def _row_norms(block):
+        # L2 norm of the weight row of every output neuron, BN folded
+        if type(block) == LinearBlock:
+            norms = block.FC.weight.norm(dim=1)
+        else:
+            norms = block.Conv.weight.flatten(1).norm(dim=1)
+        norms = norms * LipschitzBound._bn_scale(block, len(norms), norms).abs()
+        return norms if type(block) == LinearBlock else norms.view(-1, 1, 1)
+
+    @staticmethod
+    def _slope(act, z):
+        # absolute slope of a piecewise linear activation at the anchor
+        negative_slope = act.negative_slope if type(act) == nn.LeakyReLU else 0.0
+        return torch.where(z > 0, torch.ones_like(z), torch.full_like(z, abs(negative_slope)))
+
+    @staticmethod
+    def _pool_gap(pool, x, after_relu):
+        # difference between the largest and second largest input of every window
+        kernel, stride = pool.kernel_size, pool.stride or pool.kernel_size
+        windows = F.unfold(x.flatten(0, 1).unsqueeze(1), kernel, padding=pool.padding, stride=stride)
+        top = windows.topk(2, dim=1).values
+        gap = top[:, 0] - top[:, 1]
+        if after_relu:
+            # a maximum of 0 after a ReLU: every input of the window is an inactive neuron, constant in the ball
+            gap = torch.where(top[:, 0] <= 0, torch.full_like(gap, float('inf')), gap)
+        return gap
+
+    def fixed_radius(self, events):
+        """
+        @return: radius of the L2 ball around the anchor in which the network is affine
+        """
+        blocks = {block: i for i, block in enumerate(self.lip.blocks)}
+        acts = {block.Act: block for block in self.lip.blocks}
+        masks = [self._slope(module, z) for module, z in events if module in acts and check_activation(module)]
+        norms = self.lip.upper_norms(masks)[0]
+
+        # prefix: Lipschitz upper bound of the network before the current layer, with the slopes of the anchor
+        radius, prefix, last_act = float('inf'), self.lip.scale, None
+        with torch.no_grad():
+            for module, z in events:
+                if module in acts:
+                    block = acts[module]
+                    if check_activation(module):
+                        margin = z[0].abs() / (self._row_norms(block) * prefix).clamp_min(1e-12)
+                        radius = min(radius, margin.min().item())
+                    prefix = prefix * norms[blocks[block]]
+                    last_act = module
+                else:
+                    gap = self._pool_gap(module, z, type(last_act) == nn.ReLU)
+                    radius = min(radius, (gap.min() / (2 * prefix)).item())
+        return radius
+
+    def margin_radius(self, x, out):
+        """
+        @return: predicted class, and the radius within which the affine logits keep it
+        """
+        c = out.argmax(1).item()
+        num_cls = out.shape[1]
+        x_rep = x.repeat((num_cls,) + (1,) * (x.dim() - 1)).requires_grad_(True)
+        logits = self.net(x_rep)
+        diff = logits[:, c] - logits[torch.arange(num_cls), torch.arange(num_cls)]
+        grad, = torch.autograd.grad(diff.sum(), x_rep)
+        radius = diff.detach() / grad.flatten(1).norm(dim=1).clamp_min(1e-12)
+        radius[c] = float('inf')
+        return c, radius.min().item()
+
+    def certify(self, x):
+        """
+        @param x: the anchor [1 x channel x height x width]
+        @return: (predicted class, certified L2 radius of the base classifier)
+        """
+        self.net.eval()
+        out, events = self.anchor_events(x)
+        c, margin = self.margin_radius(x, out)
+        return c, min(self.fixed_radius(events), margin)
+
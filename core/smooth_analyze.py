@@ -1,3 +1,7 @@
+import json
+import os
+import time
+
 import numpy as np
 import matplotlib
 
@@ -7,6 +11,10 @@ from typing import *
 import pandas as pd
 import seaborn as sns
 import math
+from statsmodels.stats.proportion import proportion_confint
+
+from core.bootstrap import Bootstrap, bin_curve
+from core.cert_results import read_results
 
 sns.set()
 
@@ -16,13 +24,49 @@ class Accuracy(object):
         raise NotImplementedError()
 
 
+class CertifiedRadii(object):
+    """
+    Certified radii of the correct predictions of a results file, sorted once for all radius queries. Images
+    skipped by the pre-certificate of smooth_pred have no smoothed certificate, they are left out of the curve and
+    only counted in num_skipped
+    """
+
+    def __init__(self, correct: np.ndarray, radius: np.ndarray, skipped: np.ndarray = None):
+        kept = np.ones(len(correct), dtype=bool) if skipped is None else ~skipped.astype(bool)
+        self.num_skipped = len(correct) - int(kept.sum())
+        self.num_examples = int(kept.sum())
+        self.sorted_radii = np.sort(radius[correct.astype(bool) & kept])
+
+    def at_radii(self, radii: np.ndarray) -> np.ndarray:
+        # ratio of the examples that are correct with a certified radius >= r
+        above = len(self.sorted_radii) - np.searchsorted(self.sorted_radii, radii, side='left')
+        return above / max(self.num_examples, 1)
+
+
+# parsed results files: path -> (modification time, CertifiedRadii)
+_RESULTS_CACHE = {}
+
+
+def load_certified_radii(data_file_path: str) -> CertifiedRadii:
+    """
+    Parse a results file (tsv, or a store of core/cert_results.py) once, it is parsed again only if it has been
+    modified since
+    """
+    mtime = os.path.getmtime(data_file_path)
+    cached = _RESULTS_CACHE.get(data_file_path)
+    if cached is None or cached[0] != mtime:
+        data, _ = read_results(data_file_path, ["correct", "radius", "skipped"])
+        cached = (mtime, CertifiedRadii(data["correct"], data["radius"], data.get("skipped")))
+        _RESULTS_CACHE[data_file_path] = cached
+    return cached[1]
+
+
 class ApproximateAccuracy(Accuracy):
     def __init__(self, data_file_path: str):
         self.data_file_path = data_file_path
 
     def at_radii(self, radii: np.ndarray) -> np.ndarray:
-        df = pd.read_csv(self.data_file_path, delimiter="\t")
-        return np.array([self.at_radius(df, radius) for radius in radii])
+        return load_certified_radii(self.data_file_path).at_radii(np.asarray(radii))
 
     def at_radius(self, df: pd.DataFrame, radius: float):
         return (df["correct"] & (df["radius"] >= radius)).mean()
@@ -35,16 +79,112 @@ class HighProbAccuracy(Accuracy):
         self.rho = rho
 
     def at_radii(self, radii: np.ndarray) -> np.ndarray:
-        df = pd.read_csv(self.data_file_path, delimiter="\t")
-        return np.array([self.at_radius(df, radius) for radius in radii])
+        certified = load_certified_radii(self.data_file_path)
+        return self.bound(certified.at_radii(np.asarray(radii)), certified.num_examples)
 
     def at_radius(self, df: pd.DataFrame, radius: float):
         mean = (df["correct"] & (df["radius"] >= radius)).mean()
-        num_examples = len(df)
+        return self.bound(mean, len(df))
+
+    def bound(self, mean, num_examples: int):
         return (mean - self.alpha - math.sqrt(self.alpha * (1 - self.alpha) * math.log(1 / self.rho) / num_examples)
                 - math.log(1 / self.rho) / (3 * num_examples))
 
 
+class BootstrapAccuracy(Accuracy):
+    """ Certified accuracy of a results file with a bootstrap confidence band, see core/bootstrap.py """
+
+    def __init__(self, data_file_path: str, bootstrap: Bootstrap = None):
+        self.data_file_path = data_file_path
+        self.bootstrap = bootstrap or Bootstrap()
+
+    def at_radii(self, radii: np.ndarray) -> np.ndarray:
+        return load_certified_radii(self.data_file_path).at_radii(np.asarray(radii))
+
+    def band(self, radii: np.ndarray):
+        """ @return: lower and upper bounds of the certified accuracy at radii """
+        certified = load_certified_radii(self.data_file_path)
+        # the images are resampled independently of their order: the correct ones first, then the others
+        num_correct = len(certified.sorted_radii)
+        correct = np.arange(certified.num_examples) < num_correct
+        radius = np.zeros(certified.num_examples)
+        radius[:num_correct] = certified.sorted_radii
+        _, lower, upper = self.bootstrap.band(correct, radius, radii)
+        return lower, upper
+
+
+class IncrementalAccuracy(Accuracy):
+    """
+    Certified accuracy of a run in progress: a histogram of the certified radii of the correct predictions on a
+    fixed radius grid, updated in O(1) per image. The curve is exact at the grid radii and a lower bound between
+    them. If output_path is set, the curve and its Clopper-Pearson intervals are written to a JSON file at most
+    every interval seconds, replacing the file atomically so that readers never see a partial one.
+    """
+
+    def __init__(self, radii: np.ndarray, output_path: str = None, interval: float = 5.0, alpha: float = 0.05):
+        self.radii = np.asarray(radii, dtype=float)
+        # counts[k]: images that are certified at the first k grid radii
+        self.counts = np.zeros(len(self.radii) + 1, dtype=np.int64)
+        self.num_examples = 0
+        # images skipped by the pre-certificate, not part of the curve
+        self.num_skipped = 0
+        self.output_path = output_path
+        self.interval = interval
+        self.alpha = alpha
+        self.last_dump = time.time()
+
+    def update(self, correct: bool, radius: float):
+        k = int(np.searchsorted(self.radii, radius, side='right')) if correct else 0
+        self.counts[k] += 1
+        self.num_examples += 1
+        if self.output_path is not None and time.time() - self.last_dump >= self.interval:
+            self.dump()
+
+    def skip(self):
+        self.num_skipped += 1
+
+    def curve(self) -> np.ndarray:
+        return bin_curve(self.counts, self.num_examples)
+
+    def at_radii(self, radii: np.ndarray) -> np.ndarray:
+        curve = np.append(self.curve(), 0)
+        return curve[np.searchsorted(self.radii, radii, side='left')]
+
+    def confidence_intervals(self):
+        """ @return: lower and upper (1 - alpha) Clopper-Pearson bounds of the curve """
+        if self.num_examples == 0:
+            return np.zeros(len(self.radii)), np.ones(len(self.radii))
+        certified = self.curve() * self.num_examples
+        lower, upper = proportion_confint(np.round(certified), self.num_examples, alpha=self.alpha, method="beta")
+        return np.nan_to_num(lower, nan=0.0), np.nan_to_num(upper, nan=1.0)
+
+    def dump(self):
+        lower, upper = self.confidence_intervals()
+        state = {"num_examples": self.num_examples, "num_skipped": self.num_skipped, "time": time.time(),
+                 "alpha": self.alpha,
+                 "radii": self.radii.tolist(), "accuracy": self.curve().tolist(), "lower": lower.tolist(),
+                 "upper": upper.tolist()}
+        tmp_path = self.output_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.output_path)
+        self.last_dump = time.time()
+
+
+def paired_difference(data_file_a: str, data_file_b: str, radii: np.ndarray, bootstrap: Bootstrap = None):
+    """
+    Certified accuracy of run a minus run b on their common images, with a paired bootstrap confidence band;
+    images skipped by the pre-certificate in either run are left out
+    @return: (difference, lower, upper) at radii
+    """
+    runs = []
+    for data_file_path in [data_file_a, data_file_b]:
+        data, _ = read_results(data_file_path, ["idx", "correct", "radius", "skipped"])
+        kept = ~data["skipped"].astype(bool) if "skipped" in data else slice(None)
+        runs.append((data["idx"][kept], data["correct"][kept], data["radius"][kept]))
+    return (bootstrap or Bootstrap()).paired_difference(runs[0], runs[1], np.asarray(radii))
+
+
 class Line(object):
     def __init__(self, quantity: Accuracy, legend: str, plot_fmt: str = "", scale_x: float = 1):
         self.quantity = quantity
@@ -54,18 +194,43 @@ class Line(object):
 
 
 def plot_certified_accuracy(outfile: str, title: str, max_radius: float,
-                            lines: List[Line], radius_step: float = 0.01) -> None:
+                            lines: List[Line], radius_step: float = 0.01, bands: bool = False) -> None:
     radii = np.arange(0, max_radius + radius_step, radius_step)
     plt.figure()
     for line in lines:
         plt.plot(radii * line.scale_x, line.quantity.at_radii(radii), line.plot_fmt)
+        # confidence band of the lines that have one (BootstrapAccuracy)
+        if bands and hasattr(line.quantity, "band"):
+            lower, upper = line.quantity.band(radii)
+            plt.fill_between(radii * line.scale_x, lower, upper, color=plt.gca().lines[-1].get_color(), alpha=0.2)
 
     plt.ylim((0, 1))
     plt.xlim((0, max_radius))
     plt.tick_params(labelsize=14)
     plt.xlabel("radius", fontsize=16)
     plt.ylabel("certified accuracy", fontsize=16)
-    plt.legend([method.legend for method in lines], loc='upper right', fontsize=16)
+    plt.legend(plt.gca().lines, [method.legend for method in lines], loc='upper right', fontsize=16)
+    plt.savefig(outfile + ".pdf")
+    plt.tight_layout()
+    plt.title(title, fontsize=20)
+    plt.tight_layout()
+    plt.savefig(outfile + ".png", dpi=300)
+    plt.close()
+
+
+def plot_from_matrix(outfile: str, title: str, radii: np.ndarray, legends: List[str], accuracies: np.ndarray,
+                     plot_fmts: List[str] = None) -> None:
+    """ Same figure as plot_certified_accuracy, from precomputed curves accuracies[i, j] at radii[j] """
+    plt.figure()
+    for i, accuracy in enumerate(accuracies):
+        plt.plot(radii, accuracy, plot_fmts[i] if plot_fmts else "")
+
+    plt.ylim((0, 1))
+    plt.xlim((0, radii[-1]))
+    plt.tick_params(labelsize=14)
+    plt.xlabel("radius", fontsize=16)
+    plt.ylabel("certified accuracy", fontsize=16)
+    plt.legend(legends, loc='upper right', fontsize=16)
     plt.savefig(outfile + ".pdf")
     plt.tight_layout()
     plt.title(title, fontsize=20)
@@ -93,13 +258,23 @@ def smallplot_certified_accuracy(outfile: str, title: str, max_radius: float,
     plt.close()
 
 
+def certified_accuracy_matrix(quantities: List[Accuracy], radii: np.ndarray) -> np.ndarray:
+    """ @return: [len(quantities) x len(radii)], the curve of every quantity at radii """
+    accuracies = np.zeros((len(quantities), len(radii)))
+    for i, quantity in enumerate(quantities):
+        accuracies[i, :] = quantity.at_radii(radii)
+    return accuracies
+
+
 def latex_table_certified_accuracy(outfile: str, radius_start: float, radius_stop: float, radius_step: float,
                                    methods: List[Line]):
     radii = np.arange(radius_start, radius_stop + radius_step, radius_step)
-    accuracies = np.zeros((len(methods), len(radii)))
-    for i, method in enumerate(methods):
-        accuracies[i, :] = method.quantity.at_radii(radii)
+    accuracies = certified_accuracy_matrix([method.quantity for method in methods], radii)
+    latex_table_from_matrix(outfile, radii, [method.legend for method in methods], accuracies)
 
+
+def latex_table_from_matrix(outfile: str, radii: np.ndarray, legends: List[str], accuracies: np.ndarray):
+    """ LaTeX table of precomputed curves, accuracies[i, j] is the accuracy of legends[i] at radii[j] """
     f = open(outfile, 'w')
 
     for radius in radii:
@@ -108,8 +283,8 @@ def latex_table_certified_accuracy(outfile: str, radius_start: float, radius_sto
 
     f.write("\midrule\n")
 
-    for i, method in enumerate(methods):
-        f.write(method.legend)
+    for i, legend in enumerate(legends):
+        f.write(legend)
         for j, radius in enumerate(radii):
             if i == accuracies[:, j].argmax():
                 txt = r" & \textbf{" + "{:.2f}".format(accuracies[i, j]) + "}"
@@ -123,10 +298,12 @@ def latex_table_certified_accuracy(outfile: str, radius_start: float, radius_sto
 def markdown_table_certified_accuracy(outfile: str, radius_start: float, radius_stop: float, radius_step: float,
                                       methods: List[Line]):
     radii = np.arange(radius_start, radius_stop + radius_step, radius_step)
-    accuracies = np.zeros((len(methods), len(radii)))
-    for i, method in enumerate(methods):
-        accuracies[i, :] = method.quantity.at_radii(radii)
+    accuracies = certified_accuracy_matrix([method.quantity for method in methods], radii)
+    markdown_table_from_matrix(outfile, radii, [method.legend for method in methods], accuracies)
+
 
+def markdown_table_from_matrix(outfile: str, radii: np.ndarray, legends: List[str], accuracies: np.ndarray):
+    """ Markdown table of precomputed curves, accuracies[i, j] is the accuracy of legends[i] at radii[j] """
     f = open(outfile, 'w')
     f.write("|  | ")
     for radius in radii:
@@ -138,8 +315,8 @@ def markdown_table_certified_accuracy(outfile: str, radius_start: float, radius_
         f.write(" --- |")
     f.write("\n")
 
-    for i, method in enumerate(methods):
-        f.write("<b> {} </b>| ".format(method.legend))
+    for i, legend in enumerate(legends):
+        f.write("<b> {} </b>| ".format(legend))
         for j, radius in enumerate(radii):
             if i == accuracies[:, j].argmax():
                 txt = "{:.2f}<b>*</b> |".format(accuracies[i, j])
@@ -283,7 +283,7 @@ def check_activation(layer):
 
 
 def to_numpy(tensor):
-    if type(tensor) == np.ndarray:
+    if isinstance(tensor, np.ndarray):
         return tensor
     else:
         return tensor.cpu().detach().numpy()
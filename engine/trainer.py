@@ -7,6 +7,7 @@ from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.data.distributed import DistributedSampler
 
 from attack import *
+from core.DualNet import DualNet
 from engine.logger import Log
 from models import *
 
@@ -23,8 +24,16 @@ class BaseTrainer:
         self.scaler = GradScaler()
         self.attack = set_attack(self.model, self.args)
 
-        self.attack = DDP(self.attack, device_ids=[rank], output_device=rank)
-        self.model = DDP(self.model, device_ids=[rank], output_device=rank)
+        if self.args.train_mode == 'dual':
+            # clean and noisy branches go through DualNet in one concatenated forward. DualNet is the only DDP
+            # wrapper of the parameters, self.model stays the bare network (dual_net.module.net) for validation
+            self.dual_net = DDP(DualNet(self.model, args), device_ids=[rank], output_device=rank)
+            self.model = self.dual_net.module.net
+        elif self.args.train_mode == 'std':
+            self.attack = DDP(self.attack, device_ids=[rank], output_device=rank)
+            self.model = DDP(self.model, device_ids=[rank], output_device=rank)
+        else:
+            raise NameError('Train mode {} not found'.format(self.args.train_mode))
 
         self.time_metric = MetricLogger()
         self.metrics = MetricLogger()
@@ -38,7 +47,14 @@ class BaseTrainer:
         self.start_epoch, self.best_acc = self.resume()
         dist.barrier()
 
+    @property
+    def net(self):
+        # the network without its DDP wrapper
+        return self.model if self.args.train_mode == 'dual' else self.model.module
+
     def train_step(self, images, labels):
+        if self.args.train_mode == 'dual':
+            return self.dual_step(images, labels)
         self.optimizer.zero_grad()
         # images, labels = images.to(self.rank), labels.to(self.rank)
         images = self.attack(images, labels)
@@ -46,14 +62,7 @@ class BaseTrainer:
             outputs = self.model(images)
             loss = self.loss_function(outputs, labels)
 
-        self.scaler.scale(loss).backward()
-        self.scaler.step(self.optimizer)
-        scale = self.scaler.get_scale()
-        self.scaler.update()
-        # loss.backward()
-        # self.optimizer.step()
-        if not scale > self.scaler.get_scale():
-            self.lr_scheduler.step()
+        self.optimizer_step(loss)
 
         top1, top5 = accuracy(outputs, labels)
         self.metrics.update(
@@ -63,6 +72,45 @@ class BaseTrainer:
         )
         self.metrics.all_reduce()
 
+    def dual_step(self, images, labels):
+        """
+        Certifiable training: the clean images and their noisy copies are pushed through DualNet together,
+        the neurons whose activation pattern differs between the two are scaled by eta_float.
+        """
+        self.optimizer.zero_grad()
+        noisy = self.noisy_images(images)
+        with torch.cuda.amp.autocast(dtype=torch.float16):
+            outputs, noisy_outputs, _ = self.dual_net(images, noisy, self.args.eta_fixed, self.args.eta_float)
+            loss = self.loss_function(outputs, labels) + self.loss_function(noisy_outputs, labels)
+
+        self.optimizer_step(loss)
+
+        top1, top5 = accuracy(outputs, labels)
+        noisy_top1, _ = accuracy(noisy_outputs, labels)
+        self.metrics.update(
+            top1=(top1, len(images)), top5=(top5, len(images)), noisy_top1=(noisy_top1, len(images)),
+            loss=(loss, len(images)),
+            mask_ratio=(self.dual_net.module.mask_ratio, 1),
+            lr=(self.get_lr(), 1)
+        )
+        self.metrics.all_reduce()
+
+    def noisy_images(self, images):
+        if self.args.noise_type == 'noise':
+            return images + torch.randn_like(images) * self.args.noise_eps
+        else:
+            raise NameError('Noise type {} not found'.format(self.args.noise_type))
+
+    def optimizer_step(self, loss):
+        self.scaler.scale(loss).backward()
+        self.scaler.step(self.optimizer)
+        scale = self.scaler.get_scale()
+        self.scaler.update()
+        # loss.backward()
+        # self.optimizer.step()
+        if not scale > self.scaler.get_scale():
+            self.lr_scheduler.step()
+
     # def warmup(self):
     #     if self.args.warmup_steps == 0:
     #         return
@@ -98,7 +146,9 @@ class BaseTrainer:
 
             iter_time = time.time() - cur_time
 
-            self.time_metric.update(iter_time=(iter_time, 1), data_time=(data_time, 1))
+            # images per second on this rank
+            self.time_metric.update(iter_time=(iter_time, 1), data_time=(data_time, 1),
+                                    throughput=(len(images) / iter_time, 1))
             self.time_metric.all_reduce()
             self.metrics.all_reduce()
             cur_time = time.time()
@@ -112,9 +162,8 @@ class BaseTrainer:
         self.model.eval()
         for images, labels in self.test_loader:
             images, labels = images.to(self.rank, non_blocking=True), labels.to(self.rank, non_blocking=True)
-            # with torch.no_grad():
             # print(images.shape)
-            with torch.cuda.amp.autocast(dtype=torch.float16):
+            with torch.no_grad(), torch.cuda.amp.autocast(dtype=torch.float16):
                 pred = self.model(images)
             top1, top5 = accuracy(pred, labels)
             self.metrics.update(top1=(top1, len(images)), top5=(top5, len(images)))
@@ -174,7 +223,7 @@ class BaseTrainer:
     def save_ckpt(self, cur_epoch, best_acc=0, name=None):
         ckpt = {
             'epoch': cur_epoch,
-            'model_state_dict': self.model.module.state_dict(),
+            'model_state_dict': self.net.state_dict(),
             'optimizer_state_dict': self.optimizer.state_dict(),
             'best_acc': best_acc
         }
@@ -197,7 +246,7 @@ class BaseTrainer:
             self.logger.info('CKPT not found, start from Epoch 0')
             print('CKPT not found, start from Epoch 0')
             return 0, 0
-        self.model.module.load_state_dict(ckpt['model_state_dict'])
+        self.net.load_state_dict(ckpt['model_state_dict'])
         self.logger.info('Loading Finished')
         print('Loading Finished')
         
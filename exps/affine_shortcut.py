@@ -0,0 +1,120 @@
+import time
+
+import torch
+
+from core.affine import AffineShortcut
+from core.DualNet import DualNet
+from exps.utils import bench_args, synchronize
+from models.base_model import build_model
+from models.blocks import *
+
+
+class TinyNet(nn.Module):
+    """
+    Small models/dnn MLP (conv=False) or models/mini VGG (conv=True) without the input normalization, which
+    needs CUDA, so that the check runs on the CPU
+    """
+
+    def __init__(self, conv, width=16, num_cls=5):
+        super().__init__()
+        if conv:
+            trunk = [ConvBlock(3, 4, act='ReLU'), nn.MaxPool2d(kernel_size=2, stride=2), nn.Flatten()]
+            in_size = 4 * 4 * 4
+        else:
+            trunk = [nn.Flatten()]
+            in_size = 16
+        self.layers = nn.Sequential(*trunk, LinearBlock(in_size, width, act='ReLU'),
+                                    LinearBlock(width, width, act='ReLU'), LinearBlock(width, width, act='ReLU'),
+                                    LinearBlock(width, num_cls, act=None))
+        # BN statistics away from the identity, so that the folding of BN is checked as well
+        for m in self.modules():
+            if type(m) in [nn.BatchNorm1d, nn.BatchNorm2d]:
+                m.running_mean.uniform_(-0.5, 0.5)
+                m.running_var.uniform_(0.5, 2.0)
+                m.weight.data.uniform_(0.5, 1.5)
+                m.bias.data.uniform_(-0.5, 0.5)
+
+    def forward(self, x):
+        return self.layers(x)
+
+
+def check_affine_shortcut(conv, eta_float=0.1, batch_size=64, seed=0):
+    """
+    CPU check, in float64, that AffineShortcut.predict gives the output of DualNet.predict(x, 0, eta_float):
+    on copies of the anchor (every row takes the shortcut), on samples with little noise, and on samples with
+    large noise where rows fall back to the masked blocks (MaskScale). Composing the head reorders the sums of the
+    matmuls, so outputs are compared up to rounding and the predicted classes exactly.
+    """
+    torch.manual_seed(seed)
+    net = TinyNet(conv).double().eval()
+    dual_net = DualNet(net, bench_args('tiny', 'mini' if conv else 'dnn'))
+    shortcut = AffineShortcut(dual_net)
+    shape = (3, 8, 8) if conv else (1, 4, 4)
+    x = torch.rand((1,) + shape, dtype=torch.double)
+    shortcut.set_anchor(x)
+    anchors = dual_net.anchor_pattern(x, 0.0)
+
+    ratios = {}
+    with torch.no_grad():
+        for sigma in [0.0, 1e-6, 1.0]:
+            batch = x + torch.randn((batch_size,) + shape, dtype=torch.double) * sigma
+            out = dual_net.predict(batch, 0.0, eta_float, None, anchors)
+            out_short = shortcut.predict(batch, eta_float)
+            assert torch.allclose(out, out_short, rtol=0, atol=1e-10), (conv, sigma, (out - out_short).abs().max())
+            assert torch.equal(out.argmax(1), out_short.argmax(1)), (conv, sigma)
+            ratios[sigma] = shortcut.shortcut_ratio.item()
+    # the anchor keeps its own pattern, large noise must exercise the fallback
+    assert ratios[0.0] == 1.0, ratios
+    assert ratios[1.0] < 1.0, ratios
+    return ratios
+
+
+def timed(fn, *args, steps=20):
+    fn(*args)
+    synchronize(args[0].device)
+    start = time.time()
+    for _ in range(steps):
+        out = fn(*args)
+    synchronize(args[0].device)
+    return out, (time.time() - start) / steps
+
+
+def speedup(args, input_shape, sigmas, device, batch_size=512, eta_float=0.1, steps=20):
+    """
+    DualNet.predict against AffineShortcut.predict on noisy samples of one random anchor, for each noise level:
+    the ratio of rows that skip the head (fixed-neuron pattern of the anchor in every head block), the agreement of
+    the predicted classes and the time of both
+    """
+    model = build_model(args).to(device).eval()
+    dual_net = DualNet(model, args)
+    shortcut = AffineShortcut(dual_net)
+    x = torch.rand((1,) + input_shape, device=device)
+    shortcut.set_anchor(x)
+    anchors = dual_net.anchor_pattern(x, 0.0)
+    res = []
+    with torch.no_grad():
+        for sigma in sigmas:
+            batch = x + torch.randn((batch_size,) + input_shape, device=device) * sigma
+            out, t_full = timed(dual_net.predict, batch, 0.0, eta_float, None, anchors, steps=steps)
+            out_short, t_short = timed(shortcut.predict, batch, eta_float, steps=steps)
+            res.append((sigma, shortcut.shortcut_ratio.item(),
+                        (out.argmax(1) == out_short.argmax(1)).float().mean().item(), t_full, t_short))
+    return res
+
+
+if __name__ == '__main__':
+    for conv in [False, True]:
+        print('mini' if conv else 'dnn', check_affine_shortcut(conv))
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    batch_size, steps = (512, 20) if device.type == 'cuda' else (128, 5)
+    sigmas = [0.001, 0.01, 0.05, 0.12, 0.25, 0.5]
+    for name, args, input_shape in [
+        ('dnn', bench_args('DNN', 'dnn', 'mnist', input_size=784, width=1000, depth=9), (1, 28, 28)),
+        ('mini vgg16', bench_args('VGG16', 'mini'), (3, 32, 32)),
+    ]:
+        for sigma, ratio, agree, t_full, t_short in speedup(args, input_shape, sigmas, device, batch_size,
+                                                             steps=steps):
+            print('{0}\t{1}\tsigma {2}\tshortcut rows: {3:.3f}\tsame class: {4:.4f}\tdual: {5:.5f} s\t'
+                  'shortcut: {6:.5f} s\tspeedup: {7:.2f}'.format(
+                    device, name, sigma, ratio, agree, t_full, t_short, t_full / t_short))
@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+import torch
+
+from engine.dataloader import set_dataset
+
+
+def ap_lip_test(model, args):
+    """
+    Local Lipschitz constants around the first num_test test inputs under PGD-found L-inf perturbations, for every
+    epsilon, saved as [num_test x num_epsilon] to exp_dir/ap_lip.npy
+    """
+    _, dataset = set_dataset(args)
+    xs = torch.stack([dataset[i][0] for i in range(min(int(args.num_test), len(dataset)))]).cuda()
+    model.eval()
+    lip = adversarial_lip(model, xs, args.epsilon, args.lip_steps, args.sample_size)
+    np.save(os.path.join(args.exp_dir, 'ap_lip.npy'), lip)
+    return lip
+
+
+def adversarial_lip(model, xs, epsilon, steps, batch_size):
+    """
+    Every (image, epsilon) pair is one row of the batch, each row has its own radius. PGD maximizes
+    ||f(x + delta) - f(x)||_2 over ||delta||_inf <= eps with a random start, the rows are independent so one backward
+    of the summed objective gives the gradient of every row.
+    @return: ndarray [num_images x num_epsilon] of ||f(x + delta) - f(x)||_2 / ||delta||_inf
+    """
+    eps = torch.tensor(epsilon, dtype=xs.dtype, device=xs.device)
+    images = torch.arange(len(xs), device=xs.device).repeat_interleave(len(eps))
+    radii = eps.repeat(len(xs))
+    shape = (-1,) + (1,) * (xs.dim() - 1)
+    with torch.no_grad():
+        clean = torch.cat([model(xs[i: i + batch_size]) for i in range(0, len(xs), batch_size)])
+
+    lip = torch.zeros(len(images), dtype=torch.float, device=xs.device)
+    for start in range(0, len(images), batch_size):
+        rows = slice(start, start + batch_size)
+        x, r, f_x = xs[images[rows]], radii[rows].view(shape), clean[images[rows]]
+        # the perturbed input stays in [0, 1]
+        low, high = torch.maximum(-r, -x), torch.minimum(r, 1 - x)
+        delta = torch.max(torch.min((torch.rand_like(x) * 2 - 1) * r, high), low)
+        for _ in range(steps):
+            delta.requires_grad_(True)
+            change = (model(x + delta) - f_x).norm(p=2, dim=1)
+            grad, = torch.autograd.grad(change.sum(), delta)
+            with torch.no_grad():
+                delta = torch.max(torch.min(delta + 2.5 * r / steps * grad.sign(), high), low)
+        with torch.no_grad():
+            change = (model(x + delta) - f_x).norm(p=2, dim=1)
+            lip[rows] = change / delta.flatten(1).abs().amax(dim=1).clamp_min(1e-12)
+    return lip.view(len(xs), len(eps)).cpu().numpy()
@@ -0,0 +1,81 @@
+import time
+import types
+
+import torch
+
+from core.DualNet import DualNet
+from exps.utils import bench_args, in_fresh_process, peak_memory, synchronize
+from models.base_model import build_model
+
+
+def repeated_fix_single_batch(self, batch_x, segments=None):
+    # the mask before the anchor was broadcast: a batch-sized copy of the anchor pre-activation at every activation
+    dims = len(batch_x.shape)
+    x_0_pattern = (batch_x - self.gamma[0])[0].repeat((len(batch_x),) + (1,) * (dims - 1))
+    return x_0_pattern * (batch_x - self.gamma[0]) > 0
+
+
+def predict_memory(args, batch_size, device, data_size=224, repeated=False):
+    """
+    Peak memory (MB) of DualNet.predict on a batch whose first row is the anchor, with the broadcast anchor or,
+    if repeated, with the anchor repeated to the batch size as before
+    """
+    model = build_model(args).to(device).eval()
+    dual_net = DualNet(model, args)
+    if repeated:
+        dual_net.compute_fix_single_batch = types.MethodType(repeated_fix_single_batch, dual_net)
+    x = torch.rand((batch_size, 3, data_size, data_size), device=device)
+    with torch.no_grad():
+        return peak_memory(dual_net.predict, x, 0.0, 0.1, device=device)
+
+
+def train_step_memory(args, batch_size, device, data_size=224, steps=10):
+    """
+    Peak memory (MB) of the first DualNet training step on clean / noisy pairs (with args.dual_ckpt activations
+    per checkpointed segment, 0 for none), and the mean time (s) of the next steps
+    """
+    model = build_model(args).to(device).train()
+    dual_net = DualNet(model, args)
+    loss_fn = torch.nn.CrossEntropyLoss()
+    x = torch.rand((batch_size, 3, data_size, data_size), device=device)
+    labels = torch.randint(0, args.num_cls, (batch_size,), device=device)
+
+    def step():
+        out_1, out_2, _ = dual_net(x, x + torch.randn_like(x) * 0.1, 0.0, 0.1)
+        loss = loss_fn(out_1, labels) + loss_fn(out_2, labels)
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+
+    mem = peak_memory(step, device=device)
+    start = time.time()
+    for _ in range(steps):
+        step()
+    synchronize(device)
+    return mem, (time.time() - start) / steps
+
+
+def measure(fn, *args):
+    # on the CPU the peak resident size only grows, every measurement needs its own process
+    device = args[2]
+    return fn(*args) if device.type == 'cuda' else in_fresh_process(fn, *args)
+
+
+if __name__ == '__main__':
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    batch_sizes = [32, 64, 128] if device.type == 'cuda' else [8, 16, 32]
+    for net in ['vgg16', 'resnet50']:
+        args = bench_args(net, 'net', 'imagenet', 1000)
+        for batch_size in batch_sizes:
+            broadcast = measure(predict_memory, args, batch_size, device)
+            repeated = measure(predict_memory, args, batch_size, device, 224, True)
+            print('{0}\t{1}\tpredict\tbatch {2}\tpeak mem: {3:.2f} MB\trepeated anchor: {4:.2f} MB'.format(
+                device, net, batch_size, broadcast, repeated))
+
+    batch_sizes, steps = ([16, 32, 64], 10) if device.type == 'cuda' else ([2, 4], 2)
+    for net in ['vgg16', 'resnet50']:
+        for dual_ckpt in [0, 1, 4]:
+            args = bench_args(net, 'net', 'imagenet', 1000, dual_ckpt=dual_ckpt)
+            for batch_size in batch_sizes:
+                mem, t = measure(train_step_memory, args, batch_size, device, 224, steps)
+                print('{0}\t{1}\ttrain ckpt {2}\tbatch {3}\tpeak mem: {4:.2f} MB\tstep: {5:.4f} s'.format(
+                    device, net, dual_ckpt, batch_size, mem, t))
@@ -0,0 +1,47 @@
+import time
+
+import torch
+
+from core.pattern import *
+from exps.utils import bench_args, synchronize
+from models.base_model import build_model
+
+
+def step_time(model, x, steps, after_step=None):
+    """
+    Mean time (s) of one forward followed by after_step (the retrieval of the hooks)
+    """
+    with torch.no_grad():
+        model(x)
+        synchronize(x.device)
+        start = time.time()
+        for _ in range(steps):
+            model(x)
+            if after_step is not None:
+                after_step()
+        synchronize(x.device)
+    return (time.time() - start) / steps
+
+
+def hook_overhead(args, device, batch_size=2, data_size=32, steps=200):
+    """
+    Per-forward time without hooks, with the hooks re-registered at every retrieval (ModelHook.set_up, as
+    retrieve_res did before), with a reset of the persistent hooks, and with the hooks disabled
+    """
+    model = build_model(args).to(device).eval()
+    x = torch.rand((batch_size, 3, data_size, data_size), device=device)
+    res = {'no hook': step_time(model, x, steps)}
+
+    hook = ModelHook(model, set_compact_pattern_hook, [0])
+    res['re-register'] = step_time(model, x, steps, lambda: (hook.retrieve_res(unpack, reset=False), hook.set_up()))
+    res['reset'] = step_time(model, x, steps, lambda: hook.retrieve_res(unpack))
+    hook.disable()
+    res['disabled'] = step_time(model, x, steps)
+    hook.remove()
+    return res
+
+
+if __name__ == '__main__':
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    for name, t in hook_overhead(bench_args('VGG16', 'mini'), device).items():
+        print('{0}\t{1}\t{2:.6f} s / forward'.format(device, name, t))
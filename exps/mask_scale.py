@@ -0,0 +1,60 @@
+import torch
+
+from core.DualNet import DualNet, MaskScale
+
+
+def reference(x, fixed, eta_fixed, eta_float, balance):
+    # the masked expression MaskScale replaces
+    return DualNet.x_mask(x, eta_fixed, fixed, balance) + DualNet.x_mask(x, eta_float, ~fixed, balance)
+
+
+def compare(x, fixed, eta_fixed, eta_float, balance):
+    """
+    @return: output and input gradient of MaskScale and of the reference for the same upstream gradient
+    """
+    grad_output = torch.randn_like(x)
+    res = []
+    for fn in [lambda v: MaskScale.apply(v, fixed, eta_fixed, eta_float, balance),
+               lambda v: reference(v, fixed, eta_fixed, eta_float, balance)]:
+        v = x.clone().requires_grad_(True)
+        out = fn(v)
+        grad, = torch.autograd.grad(out, v, grad_output)
+        res.append((out.detach(), grad))
+    return res
+
+
+def check_mask_scale(shape=(4, 8, 5, 5), seed=0):
+    """
+    CPU check of MaskScale against the x_mask expression, in float64: the 'pair' / 'replay' modes balanced and
+    not balanced, the 'dn' mode (x_mask on p_same plus the identity elsewhere), and torch.autograd.gradcheck
+    """
+    torch.manual_seed(seed)
+    x = torch.randn(shape, dtype=torch.double)
+    fixed = torch.rand(shape) > 0.5
+    for eta_fixed, eta_float in [(0.0, 0.1), (0.2, -0.1), (0.0, 0.0), (0.3, 0.3)]:
+        for balance in [True, False]:
+            (out, grad), (out_ref, grad_ref) = compare(x, fixed, eta_fixed, eta_float, balance)
+            # the balanced reference adds and subtracts x * eta, equal up to rounding
+            assert torch.allclose(out, out_ref, rtol=0, atol=1e-12), (eta_fixed, eta_float, balance)
+            assert torch.equal(grad, grad_ref), (eta_fixed, eta_float, balance)
+
+    # 'dn': x_mask(x, eta_dn, p_same) + x * ~p_same
+    eta_dn = 0.5
+    v = x.clone().requires_grad_(True)
+    v_ref = x.clone().requires_grad_(True)
+    out = MaskScale.apply(v, fixed, eta_dn, 0, True)
+    out_ref = DualNet.x_mask(v_ref, eta_dn, fixed) + v_ref * ~fixed
+    grad_output = torch.randn_like(x)
+    grad, = torch.autograd.grad(out, v, grad_output)
+    grad_ref, = torch.autograd.grad(out_ref, v_ref, grad_output)
+    assert torch.allclose(out, out_ref, rtol=0, atol=1e-12)
+    assert torch.equal(grad, grad_ref)
+
+    # not balanced, MaskScale is linear in x with the same scale forward and backward
+    v = x[:2, :2].clone().requires_grad_(True)
+    assert torch.autograd.gradcheck(lambda u: MaskScale.apply(u, fixed[:2, :2], 0.2, -0.1, False), (v,))
+
+
+if __name__ == '__main__':
+    check_mask_scale()
+    print('MaskScale matches x_mask')
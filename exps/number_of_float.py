@@ -15,7 +15,7 @@ def get_float_ratio(argsv):
 
     ckpt = torch.load(os.path.join(args.model_dir, 'ckpt_best.pth'))
     model.load_weights(ckpt['model_state_dict'])
-    float_hook = ModelHook(model, set_pattern_hook, [0])
+    float_hook = ModelHook(model, set_compact_pattern_hook, [0])
     mean, std = [torch.tensor(d).view(len(d), 1, 1) for d in set_mean_sed(args)]
     model.eval()
     all_flt = []
@@ -0,0 +1,51 @@
+import time
+
+import numpy as np
+
+from core.pattern_index import PatternIndex
+
+
+def clustered_patterns(num, num_bits, num_centers=1000, flip=0.01, seed=0):
+    """
+    Synthetic bit-packed patterns: random centers (linear regions) with a small ratio of flipped neurons
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.integers(0, 2, (num_centers, num_bits), dtype=np.uint8)
+    patterns = []
+    for start in range(0, num, 65536):
+        size = min(65536, num - start)
+        bits = centers[rng.integers(0, num_centers, size)]
+        bits ^= (rng.random((size, num_bits)) < flip).astype(np.uint8)
+        patterns.append(np.packbits(bits, axis=1))
+    return np.concatenate(patterns)
+
+
+def bench(num=1000000, num_bits=2048, k=40, num_queries=100, **kwargs):
+    """
+    Build time, mean query time against brute force, and recall of the Hamming-k neighbours
+    """
+    patterns = clustered_patterns(num, num_bits)
+    index = PatternIndex(**kwargs)
+
+    start = time.time()
+    index.add(patterns)
+    index.build()
+    build_time = time.time() - start
+
+    query_time, exact_time, recall = 0, 0, []
+    for row in patterns[np.random.default_rng(1).integers(0, num, num_queries)]:
+        start = time.time()
+        ids, _ = index.query(row, k)
+        query_time += time.time() - start
+        start = time.time()
+        exact_ids, _ = index.exact(row, k)
+        exact_time += time.time() - start
+        recall.append(len(np.intersect1d(ids, exact_ids)) / max(len(exact_ids), 1))
+    return build_time, query_time / num_queries, exact_time / num_queries, np.mean(recall)
+
+
+if __name__ == '__main__':
+    for num_tables, bits_per_key in [(8, 32), (16, 32), (16, 48)]:
+        build_time, query_time, exact_time, recall = bench(num_tables=num_tables, bits_per_key=bits_per_key)
+        print('tables {0}\tbits {1}\tbuild: {2:.2f} s\tquery: {3:.5f} s\tbrute force: {4:.5f} s\trecall: {5:.4f}'.format(
+            num_tables, bits_per_key, build_time, query_time, exact_time, recall))
@@ -0,0 +1,50 @@
+import tempfile
+
+import numpy as np
+import torch
+
+from core.pattern import ModelHook, set_compact_pattern_hook
+from core.pattern_store import PatternReader, PatternWriter
+from exps.affine_shortcut import TinyNet
+
+
+def check_pattern_store(Gamma, num_samples=3, num_draws=5, chunk_size=7, seed=0):
+    """
+    CPU round trip of write_hook -> PatternReader: every (sample, draw, layer) recorded by set_compact_pattern_hook
+    must come back exactly from get, and iter_layer must give all the rows in write order. chunk_size is smaller
+    than a batch so that rows span chunks; one breakpoint is stored bit-packed, several as int8.
+    """
+    torch.manual_seed(seed)
+    net = TinyNet(conv=True).eval()
+    hook = ModelHook(net, set_compact_pattern_hook, Gamma, capacity=4)
+    expected = []
+    with tempfile.TemporaryDirectory() as root:
+        writer = PatternWriter(root, chunk_size=chunk_size)
+        with torch.no_grad():
+            for sample in range(num_samples):
+                net(torch.rand(num_draws, 3, 8, 8))
+                expected.append([layer[0].result() for block in hook.stored_values.values()
+                                 for layer in block.values()])
+                writer.write_hook(hook, [sample] * num_draws, range(num_draws))
+        writer.close()
+        hook.remove()
+
+        reader = PatternReader(root)
+        assert len(reader) == num_samples * num_draws, len(reader)
+        for i, meta in enumerate(reader.layers):
+            assert meta['packed'] == (len(Gamma) == 1), meta
+            for sample in range(num_samples):
+                for draw in range(num_draws):
+                    pattern = reader.get(sample, draw, i)
+                    assert pattern.shape[0] == 1 and np.array_equal(pattern[0], expected[sample][i][draw]), \
+                        (sample, draw, i)
+            index, patterns = zip(*reader.iter_layer(i))
+            assert np.array_equal(np.concatenate(patterns), np.concatenate([e[i] for e in expected])), i
+            assert np.array_equal(np.concatenate(index)[:, 0], np.repeat(np.arange(num_samples), num_draws)), i
+        assert len(reader.get(num_samples, 0, 0)) == 0
+    return len(reader.layers)
+
+
+if __name__ == '__main__':
+    for Gamma in [[0], [-0.5, 0, 0.5]]:
+        print('Gamma {}: {} layers read back'.format(Gamma, check_pattern_store(Gamma)))
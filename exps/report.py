@@ -0,0 +1,98 @@
+import argparse
+import glob
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+import numpy as np
+
+from config import MODEL_PATH
+from core.cert_results import is_result_store
+from core.smooth_analyze import load_certified_radii, latex_table_from_matrix, markdown_table_from_matrix, \
+    plot_from_matrix
+
+# results file of smooth_pred: {method}_{N0}_{N}_{sigma_2}[_{eta_float}], '.cert' for the columnar store;
+# the '_cert.npy' / '_fixed.npy' files saved next to them are not results
+RESULT_NAME = re.compile(r'(?!.*\.npy$)[A-Za-z]+_\d+_\d+_[^_]+(_[^_]+)?(\.cert)?')
+
+
+def discover_runs(root=MODEL_PATH, dataset='*', model='*'):
+    """
+    Results files under root/<dataset>/<net>_<exp_id>/exp/
+    @return: sorted list of (dataset, model, file name, path)
+    """
+    runs = []
+    for path in sorted(glob.glob(os.path.join(root, dataset, model, 'exp', '*'))):
+        name = os.path.basename(path)
+        if not RESULT_NAME.fullmatch(name) or not (os.path.isfile(path) or is_result_store(path)):
+            continue
+        model_dir = os.path.dirname(os.path.dirname(path))
+        runs.append((os.path.basename(os.path.dirname(model_dir)), os.path.basename(model_dir), name, path))
+    return runs
+
+
+def _curves(path, radii, table_radii):
+    # the results file is parsed once for the curve and the table radii
+    certified = load_certified_radii(path)
+    return certified.at_radii(radii), certified.at_radii(table_radii)
+
+
+def _use_agg():
+    # headless rendering in the workers
+    matplotlib.use('Agg')
+
+
+def _plot(outfile, title, radii, legends, accuracies):
+    plot_from_matrix(outfile, title, radii, legends, accuracies)
+    return outfile
+
+
+def build_report(out_dir, root=MODEL_PATH, dataset='*', model='*', max_radius=1.0, num_radii=256, table_step=0.25,
+                 workers=None):
+    """
+    Load every discovered results file once (in parallel), compute all the curves into one matrix
+    [runs x radii], and write from it the tables of all runs and one figure per model directory
+    @return: runs, radii, accuracies
+    """
+    runs = discover_runs(root, dataset, model)
+    if not runs:
+        raise ValueError('No results file under {}'.format(root))
+    os.makedirs(out_dir, exist_ok=True)
+    radii = np.linspace(0, max_radius, num_radii)
+    table_radii = np.arange(0, max_radius + table_step / 2, table_step)
+    paths = [path for _, _, _, path in runs]
+    with ProcessPoolExecutor(workers, initializer=_use_agg) as pool:
+        curves = list(pool.map(_curves, paths, [radii] * len(paths), [table_radii] * len(paths), chunksize=8))
+        accuracies = np.stack([curve for curve, _ in curves])
+        table = np.stack([row for _, row in curves])
+        np.save(os.path.join(out_dir, 'curves.npy'), accuracies)
+
+        # tables at the multiples of table_step, evaluated exactly and not on the curve grid
+        legends = ['{}/{}/{}'.format(d, m, n) for d, m, n, _ in runs]
+        latex_table_from_matrix(os.path.join(out_dir, 'table.tex'), table_radii, legends, table)
+        markdown_table_from_matrix(os.path.join(out_dir, 'table.md'), table_radii, legends, table)
+
+        # one figure for the runs of each model directory
+        groups = {}
+        for i, (d, m, _, _) in enumerate(runs):
+            groups.setdefault((d, m), []).append(i)
+        futures = [pool.submit(_plot, os.path.join(out_dir, '{}_{}'.format(d, m)), '{} {}'.format(d, m), radii,
+                               [runs[i][2] for i in rows], accuracies[rows]) for (d, m), rows in groups.items()]
+        for future in futures:
+            future.result()
+    return runs, radii, accuracies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--out_dir', required=True, type=str)
+    parser.add_argument('--root', default=MODEL_PATH, type=str)
+    parser.add_argument('--dataset', default='*', type=str)
+    parser.add_argument('--model', default='*', type=str, help='glob of <net>_<exp_id>')
+    parser.add_argument('--max_radius', default=1.0, type=float)
+    parser.add_argument('--workers', default=None, type=int)
+    args = parser.parse_args()
+    runs, _, _ = build_report(args.out_dir, args.root, args.dataset, args.model, args.max_radius,
+                              workers=args.workers)
+    print('{} runs'.format(len(runs)))
@@ -1,59 +1,149 @@
-import datetime
 import os
 
+from scipy.stats import norm
+
+from core.cert_results import ResultWriter, TSVResultWriter
 from core.smooth_analyze import *
 from core.smooth_core import *
-from core.SCRFP import SMRAP
+from core.SCRFP import SCRFP
+from core.precert import PreCertifier
 from dataloader import get_val
 
 
 def smooth_test(model, args):
-    file_path = os.path.join(args.exp_dir, '_'.join([args.method, str(args.N0), str(args.N), str(args.sigma_2), str(args.eta_float)]))
     smooth_pred(model, args)
 
-    certify_res = ApproximateAccuracy(file_path).at_radii(np.linspace(0, 1, 256))
-    output_path = os.path.join(args.exp_dir, file_path + '_cert.npy')
-    print(certify_res.mean())
-    np.save(output_path, certify_res)
+    for eta_float in eta_settings(args):
+        file_path = result_path(args, eta_float)
+        # images skipped by the pre-certificate are not part of the curve, they are counted on their own
+        certify_res = ApproximateAccuracy(result_file(args, eta_float)).at_radii(np.linspace(0, 1, 256))
+        output_path = os.path.join(args.exp_dir, file_path + '_cert.npy')
+        print(eta_float, certify_res.mean(), 'skipped:', load_certified_radii(result_file(args, eta_float)).num_skipped)
+        np.save(output_path, certify_res)
     return
 
 
+def eta_settings(args):
+    if args.method == 'SMRAP' and getattr(args, 'eta_sweep', None):
+        return args.eta_sweep
+    return [args.eta_float]
+
+
+def result_path(args, eta_float):
+    return os.path.join(args.exp_dir, '_'.join([args.method, str(args.N0), str(args.N), str(args.sigma_2), str(eta_float)]))
+
+
+def live_max_radius(args):
+    """
+    Largest radius of the live curve: --live_max_radius, or the largest radius smooth_pred can certify,
+    sigma * Phi^-1(alpha ** (1 / N)) when all N samples vote for the top class
+    """
+    if getattr(args, 'live_max_radius', None) is not None:
+        return args.live_max_radius
+    return args.sigma_2 * norm.ppf(args.smooth_alpha ** (1 / args.N))
+
+
+def result_file(args, eta_float):
+    # the npz store is a directory next to where the tsv file would be
+    return result_path(args, eta_float) + ('.cert' if getattr(args, 'result_format', 'tsv') == 'npz' else '')
+
+
+def result_writer(args, eta_float):
+    columns = ['idx', 'label', 'predict', 'radius', 'correct', 'time']
+    if getattr(args, 'result_format', 'tsv') == 'tsv':
+        return TSVResultWriter(result_file(args, eta_float), columns + (['precert', 'skipped'] if args.precert else []))
+    meta = {'method': args.method, 'N0': args.N0, 'N': args.N, 'sigma_2': args.sigma_2, 'eta_float': eta_float,
+            'smooth_alpha': args.smooth_alpha, 'skip': args.skip, 'dataset': args.dataset}
+    columns += ['samples'] + (['precert', 'skipped'] if args.precert else [])
+    return ResultWriter(result_file(args, eta_float), meta, columns)
+
+
 def smooth_pred(model, args):
     if args.method == 'SMRAP':
-        smoothed_classifier = SMRAP(model, args)
+        smoothed_classifier = SCRFP(model, args)
+        pack = args.pack
     else:
         smoothed_classifier = Smooth(model, args)
+        pack = 1
+    # deterministic certificate of the base classifier, built at the first image
+    precertifier = None
 
-    # prepare output file
-    file_path = os.path.join(args.exp_dir, '_'.join([args.method, str(args.N0), str(args.N), str(args.sigma_2), str(args.eta_float)]))
-    f = open(file_path, 'w')
-    print("idx\tlabel\tpredict\tradius\tcorrect\ttime", file=f, flush=True)
+    # prepare output files, one for each eta_float setting
+    etas = eta_settings(args)
+    writers = [result_writer(args, eta_float) for eta_float in etas]
+    # running curve of every setting, readable while the run is in progress
+    live_interval = getattr(args, 'live_interval', 0)
+    live_radii = np.linspace(0, live_max_radius(args), 256)
+    live = [IncrementalAccuracy(live_radii, result_path(args, eta_float) + '_live.json', live_interval)
+            for eta_float in etas] if live_interval > 0 else []
 
-    # iterate through the dataset
-    if args.dataset.lower() == 'imagenet':
-        dataset = get_val(args)
-    else:
-        _, dataset = set_data_set(args)
-    for i in range(len(dataset)):
-
-        # only certify every args.skip examples, and stop after args.max examples
-        if i % args.skip != 0:
-            continue
-        if i == -1:
-            break
-
-        (x, label) = dataset[i]
-
-        before_time = time.time()
-        # certify the prediction of g around x
-        x = x.cuda()
-        with torch.cuda.amp.autocast(dtype=torch.float16):
-            prediction, radius = smoothed_classifier.certify(x, args.N0, args.N, args.smooth_alpha, args.batch_size)
-        after_time = time.time()
-        correct = int(prediction == label)
-
-        time_elapsed = str(datetime.timedelta(seconds=(after_time - before_time)))
-        print("{}\t{}\t{}\t{:.3}\t{}\t{}".format(
-            i, label, prediction, radius, correct, time_elapsed), file=f, flush=True)
-    torch.argmax
-    f.close()
+    # the rows certified so far are written out even if the run stops with an exception
+    try:
+        # iterate through the dataset
+        if args.dataset.lower() == 'imagenet':
+            dataset = get_val(args)
+        else:
+            _, dataset = set_data_set(args)
+
+        # only certify every args.skip examples, args.pack examples are certified together
+        indices = [i for i in range(len(dataset)) if i % args.skip == 0]
+        # per-setting, per-image, per-layer ratio of fixed neurons, in the order of the rows of the result files
+        fixed_ratio = [[] for _ in etas]
+        for k in range(0, len(indices), pack):
+            idx = indices[k: k + pack]
+            samples = [dataset[i] for i in idx]
+
+            before_time = time.time()
+            xs = torch.stack([x for x, _ in samples]).cuda()
+            precert = [None] * len(idx)
+            if args.precert:
+                if precertifier is None:
+                    precertifier = PreCertifier(model, xs.shape[1:])
+                precert = [precertifier.certify(x.unsqueeze(0)) for x in xs]
+            # images whose deterministic radius already reaches the target skip the Monte Carlo run. g is not
+            # certified for them: their rows are marked skipped, with no prediction (ABSTAIN) and a NaN radius, and
+            # are left out of the curves; the certificate of the base classifier is only in the precert column
+            rest = [j for j, p in enumerate(precert) if p is None or p[1] < args.target_radius]
+            certified = [[(Smooth.ABSTAIN, float('nan'))] * len(idx) for _ in etas]
+            if rest:
+                # certify the prediction of g around x
+                with torch.cuda.amp.autocast(dtype=torch.float16):
+                    if args.method == 'SMRAP':
+                        res = smoothed_classifier.certify_sweep(xs[rest], args.N0, args.N, args.smooth_alpha,
+                                                                args.batch_size)
+                    else:
+                        res = [[smoothed_classifier.certify(xs[rest[0]], args.N0, args.N, args.smooth_alpha,
+                                                            args.batch_size)]]
+                for setting_certified, setting_res in zip(certified, res):
+                    for j, r in zip(rest, setting_res):
+                        setting_certified[j] = r
+            after_time = time.time()
+            if args.method == 'SMRAP':
+                for setting, setting_ratio in enumerate(fixed_ratio):
+                    ratio = dict(zip(rest, smoothed_classifier.fixed_ratio[setting])) if rest else {}
+                    setting_ratio += [ratio.get(j) for j in range(len(idx))]
+
+            time_elapsed = round((after_time - before_time) / len(idx), 6)
+            for setting, (writer, setting_certified) in enumerate(zip(writers, certified)):
+                rows = zip(idx, samples, setting_certified, precert)
+                for j, (i, (_, label), (prediction, radius), p) in enumerate(rows):
+                    writer.append(idx=i, label=label, predict=prediction, radius=radius,
+                                  correct=int(prediction == label), time=time_elapsed,
+                                  samples=args.N0 + args.N if j in rest else 0,
+                                  precert=p[1] if p is not None else float('nan'), skipped=int(j not in rest))
+                    if live and j in rest:
+                        live[setting].update(prediction == label, radius)
+                    elif live:
+                        live[setting].skip()
+    finally:
+        for writer in writers:
+            writer.close()
+        for aggregator in live:
+            aggregator.dump()
+    # one file next to every result file, the ratios after the first activation depend on eta_float
+    for eta_float, setting_ratio in zip(etas, fixed_ratio):
+        known = [r for r in setting_ratio if r is not None]
+        if known:
+            # images certified by the pre-certificate alone have no sampled statistics
+            setting_ratio = [r if r is not None else np.full(len(known[0]), np.nan) for r in setting_ratio]
+            np.save(result_path(args, eta_float) + '_fixed.npy', np.array(setting_ratio))
@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+import torch
+
+from core.pattern import ModelHook, set_device_pattern_hook
+from core.utils import set_gamma
+from engine.dataloader import set_dataset
+
+
+def td_test(model, args):
+    """
+    Transition density: the number of activation-pattern changes of every layer along line segments through the
+    test inputs, saved as int64 [num_test x num_layers] to exp_dir/td_{line_breaks}_{line_radius}.npy
+    """
+    _, dataset = set_dataset(args)
+    xs = torch.stack([dataset[i][0] for i in range(min(args.num_test, len(dataset)))]).cuda()
+    file_path = os.path.join(args.exp_dir, 'td_{}_{}.npy'.format(args.line_breaks, args.line_radius))
+    model.eval()
+    return line_transitions(model, xs, args.line_breaks, args.line_radius, args.pre_batch,
+                            set_gamma(args.activation), file_path)
+
+
+def line_directions(xs):
+    # uniformly random unit (L2) direction for every input
+    directions = torch.randn_like(xs)
+    return directions / directions.flatten(1).norm(dim=1).view((-1,) + (1,) * (xs.dim() - 1))
+
+
+def line_transitions(model, xs, line_breaks, line_radius, pre_batch, Gamma, file_path):
+    """
+    Evaluate line_breaks evenly spaced points on the segment [x - r d, x + r d] of every input x.
+    The points of all lines are laid out line after line and evaluated pre_batch at a time, so a forward covers
+    several lines (or a part of one). The last pattern of every layer is carried to the next chunk, consecutive
+    points of the same line are compared on the device.
+    @return: int64 memmap [num_lines x num_layers], the number of transitions of each layer on each line
+    """
+    num_lines = len(xs)
+    directions = line_directions(xs)
+    steps = torch.linspace(-line_radius, line_radius, line_breaks, device=xs.device)
+    hook = ModelHook(model, set_device_pattern_hook, Gamma)
+
+    out, counts = None, None
+    last_patterns, last_line = None, None
+    total, done = num_lines * line_breaks, 0
+    with torch.no_grad():
+        for start in range(0, total, pre_batch):
+            points = torch.arange(start, min(start + pre_batch, total), device=xs.device)
+            lines = points // line_breaks
+            t = steps[points % line_breaks].view((-1,) + (1,) * (xs.dim() - 1))
+            model(xs[lines] + t * directions[lines])
+            patterns = [layer[0] for block in hook.retrieve_res().values() for layer in block.values()]
+
+            if out is None:
+                out = np.lib.format.open_memmap(file_path, mode='w+', dtype=np.int64,
+                                                shape=(num_lines, len(patterns)))
+                counts = torch.zeros((num_lines, len(patterns)), dtype=torch.long, device=xs.device)
+            if last_patterns is not None:
+                patterns = [torch.cat([last, p]) for last, p in zip(last_patterns, patterns)]
+                lines_ext = torch.cat([last_line, lines])
+            else:
+                lines_ext = lines
+            same_line = lines_ext[1:] == lines_ext[:-1]
+            for layer, p in enumerate(patterns):
+                changed = (p[1:] != p[:-1]).flatten(1).any(dim=1) & same_line
+                counts[:, layer].index_add_(0, lines_ext[1:], changed.long())
+            last_patterns, last_line = [p[-1:] for p in patterns], lines[-1:]
+
+            # lines before the one of the last point are complete
+            finished = int(lines[-1]) if points[-1] < total - 1 else num_lines
+            if finished > done:
+                out[done:finished] = counts[done:finished].cpu().numpy()
+                out.flush()
+                done = finished
+    hook.remove()
+    return out
@@ -0,0 +1,56 @@
+import argparse
+import resource
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import torch
+
+
+def bench_args(net, model_type, dataset='cifar10', num_cls=10, **kwargs):
+    """
+    Arguments of build_model / DualNet for the scripts of exps that build a model without a parser,
+    extra model arguments (e.g. input_size, width, depth of models/dnn, dual_ckpt) are given as kwargs
+    """
+    args = argparse.Namespace(dataset=dataset, net=net, model_type=model_type, num_cls=num_cls,
+                              activation='ReLU', batch_norm=1, config=None, dual_ckpt=0)
+    for k, v in kwargs.items():
+        setattr(args, k, v)
+    return args
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def resident_mb():
+    # current resident set size of the process (Linux)
+    with open('/proc/self/statm', 'r') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / (1024.0 * 1024.0)
+
+
+def peak_memory(fn, *args, device=torch.device('cuda')):
+    """
+    Peak memory (MB) used while running fn, above the memory in use before the call: allocated CUDA memory on a
+    GPU; on the CPU the peak resident set size of the process, which never decreases, so the number is only
+    meaningful in a fresh process whose earlier peak was lower (see in_fresh_process)
+    """
+    synchronize(device)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        fn(*args)
+        synchronize(device)
+        return (torch.cuda.max_memory_allocated(device) - base) / (1024.0 * 1024.0)
+    base = resident_mb()
+    fn(*args)
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0 - base
+
+
+def in_fresh_process(fn, *args):
+    """
+    Run fn(*args) in a new process, for CPU peak memory measurements that must not see the peaks of earlier ones
+    """
+    with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as pool:
+        return pool.submit(fn, *args).result()
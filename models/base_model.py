@@ -77,8 +77,9 @@ class NormalizeLayer(torch.nn.Module):
         :param sds: the channel standard deviations
         """
         super(NormalizeLayer, self).__init__()
-        self.means = torch.tensor(means).cuda()
-        self.sds = torch.tensor(sds).cuda()
+        # buffers follow the model to its device, non-persistent so that the weights files are unchanged
+        self.register_buffer('means', torch.tensor(means), persistent=False)
+        self.register_buffer('sds', torch.tensor(sds), persistent=False)
 
     def forward(self, x: torch.tensor):
         (batch_size, num_channels, height, width) = x.shape
@@ -8,8 +8,8 @@ class DNN(BaseModel):
     def __init__(self, args):
         super().__init__(args)
         self.args = args
-        set_up_kwargs = {'batch_norm': 1 if args.batch_norm else 0,
-                         'activation': args.activation}
+        set_up_kwargs = {'bn': bool(args.batch_norm),
+                         'act': args.activation}
         self.layers = self.set_up(**set_up_kwargs)
 
     def parse_layer_args(self):
@@ -23,7 +23,7 @@ class DNN(BaseModel):
         for i in range(self.args.depth - 1):
             layers += [LinearBlock(self.args.width, self.args.width, **kwargs)]
 
-        layers += [LinearBlock(self.args.width, self.args.num_cls, batch_norm=kwargs['batch_norm'], activation=None)]
+        layers += [LinearBlock(self.args.width, self.args.num_cls, bn=kwargs['bn'], act=None)]
 
         return nn.Sequential(*layers)
 
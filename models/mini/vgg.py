@@ -14,6 +14,7 @@ class VGG(BaseModel):
     def __init__(self, args):
         super().__init__(args)
         self.num_cls = args.num_cls
+        self.set_up_kwargs = {'bn': bool(args.batch_norm), 'act': args.activation}
 
         if args.net.lower() == 'vgg11':
             cfg = cfgs['vgg11']
@@ -53,7 +54,7 @@ class VGG(BaseModel):
                         layers += [LinearBlock(pre_filters, layer, **self.set_up_kwargs)]
                         pre_filters = layer
                     else:
-                        layers += [LinearBlock(pre_filters, self.num_cls, batch_norm=1, activation=None)]
+                        layers += [LinearBlock(pre_filters, self.num_cls, bn=True, act=None)]
         setattr(self, 'layers', nn.Sequential(*layers))
 
     def forward(self, x):
@@ -20,6 +20,10 @@ class TestParser(BaseParser):
         args, _ = self.parser.parse_known_args(self.args)
         if args.test_name == 'smoothed_certify':
             self.parser = smoothed_certify(self.parser)
+        elif args.test_name == 'td':
+            self.parser = td(self.parser)
+        elif args.test_name == 'ap_lip':
+            self.parser = ap_lip(self.parser)
 
 
 #
@@ -50,15 +54,19 @@ class TestParser(BaseParser):
 
 def ap_lip(parser):
     parser.add_argument('--epsilon', nargs='+', default=[2 / 255, 4 / 255, 8 / 255, 16 / 255], type=float)
+    # rows (image, epsilon pairs) per batch
     parser.add_argument('--sample_size', default=256, type=int)
-    parser.add_argument('--num_test', default=100)
+    parser.add_argument('--num_test', default=100, type=int)
+    parser.add_argument('--lip_steps', default=10, type=int)
     return parser
 
 
 def td(parser):
     parser.add_argument('--line_breaks', default=2048, type=int)
     parser.add_argument('--num_test', default=100, type=int)
-    parser.add_argument('--pre_batch', default=512)
+    parser.add_argument('--pre_batch', default=512, type=int)
+    # half length (L2) of the line segment through each test input
+    parser.add_argument('--line_radius', default=0.5, type=float)
     return parser
 
 
@@ -76,6 +84,21 @@ def smoothed_certify(parser):
     parser.add_argument("--N", type=int, default=10000, help="number of samples to use")
     parser.add_argument("--smooth_alpha", type=float, default=0.001, help="failure probability")
     parser.add_argument('--method', default='SMRAP', type=str)
+    # number of test images packed into the same SCRFP batches
+    parser.add_argument('--pack', default=1, type=int)
+    # several eta_float values certified together on the same noise samples, one result file per value
+    parser.add_argument('--eta_sweep', default=None, type=float, nargs='+')
+    # deterministic linear-region certificate of the base classifier (dnn / mini models), reported in a column;
+    # images whose certificate reaches target_radius skip the Monte Carlo run: they are marked in the skipped column
+    # and left out of the certified accuracy curves, which only count the images certified by Monte Carlo
+    parser.add_argument('--precert', default=0, type=int)
+    parser.add_argument('--target_radius', default=float('inf'), type=float)
+    # tsv: tab-separated text, npz: chunked columnar store (core/cert_results.py)
+    parser.add_argument('--result_format', default='tsv', choices=['tsv', 'npz'])
+    # seconds between two writes of the live certified accuracy curve ('_live.json'), 0 to disable;
+    # the curve covers [0, live_max_radius], by default up to the largest radius that can be certified
+    parser.add_argument('--live_interval', default=0, type=float)
+    parser.add_argument('--live_max_radius', default=None, type=float)
     return parser
 
 
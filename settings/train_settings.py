@@ -34,6 +34,7 @@ class TrainParser(BaseParser):
         self.parser.add_argument('--batch_norm', default=1, type=int)
         self.parser.add_argument('--activation', default='LeakyReLU', type=str)
         # trainer settings
+        # std, or dual for certifiable training through DualNet (see train_mode)
         self.parser.add_argument('--train_mode', default='std', type=str)
         self.parser.add_argument('--val_mode', default='std', type=str)
         # scheduler and optimizer
@@ -218,6 +219,8 @@ class TrainParser(BaseParser):
         self.parser.add_argument('--eta_float', default=0, type=float)
         self.parser.add_argument('--noise_type', default='noise', type=str)
         self.parser.add_argument('--noise_eps', default=0.06, type=float)
+        # activations per checkpointed segment of DualNet.forward, 0 for no checkpointing
+        self.parser.add_argument('--dual_ckpt', default=0, type=int)
 
         # Adversarial Training
 
@@ -1,11 +1,16 @@
+import sys
+
 from settings.test_setting import TestParser
 from models.base_model import build_model
 from exps.smoothed import *
 from exps.text_acc import test_acc
+from exps.transition import td_test
+from exps.ap_lip import ap_lip_test
 
 
 if __name__ == '__main__':
-    argsv = ['--test_name', 'smoothed_certify']
+    # smoothed certification unless another test is given
+    argsv = [] if '--test_name' in sys.argv else ['--test_name', 'smoothed_certify']
     torch.cuda.device_count()
     args = TestParser(argsv).get_args()
 
@@ -14,8 +19,13 @@ if __name__ == '__main__':
     model.load_weights(ckpt['model_state_dict'])
     # _, test_loader = set_loader(args)
     model.eval()
-    smooth_test(model, args)
-    test_acc(model, args)
+    if args.test_name == 'td':
+        td_test(model, args)
+    elif args.test_name == 'ap_lip':
+        ap_lip_test(model, args)
+    else:
+        smooth_test(model, args)
+        test_acc(model, args)
 
 
 